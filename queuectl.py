@@ -4,189 +4,3236 @@ import time
 import threading
 import queue
 import os
+import sys
+import hashlib
+import hmac
+import subprocess
+import shlex
+import importlib
+import traceback
+import concurrent.futures
+import multiprocessing
+import urllib.request
+import urllib.error
+import http.client
+import socket
+import socketserver
+import base64
 import random
-from datetime import datetime
+import signal
+import logging
+import logging.handlers
+import bisect
+import math
+import heapq
+import cProfile
+import pstats
+import shutil
+import tempfile
+import contextlib
+import atexit
+from collections import Counter, deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
-from filelock import FileLock
+from filelock import FileLock, Timeout
 WORKER_PID_FILE = "workers.pid"
 QUEUE_FILE = "queue.json"
 CONFIG_FILE = "config.json"
 STOP_FILE="stop.flag"
+SCALE_FILE = "scale.flag"
+AUTOSCALE_INTERVAL = 5
+LEASE_FILE = "leases.json"
+LEASE_INTERVAL = 5
+LEASE_TTL = 15
+TOKEN_ENV = "QUEUECTL_TOKEN"
+LOOPBACK_HOSTS = ("127.0.0.1", "localhost", "::1")
+REPLY_CACHE_SIZE = 10000
+NODE_ID = f"{socket.gethostname()}:{os.getpid()}"
 PROCESSED_FILE="processed.json"
 FAILED_FILE="failed.json"
+LIMITS_FILE = "limits.json"
+LIMITS_STATE_FILE = "limits_state.json"
+LIMIT_KINDS = ("queue", "tag", "prefix")
+TENANTS_FILE = "tenants.json"
+TENANTS_STATE_FILE = "tenants_state.json"
+SCHEDULE_FILE = "scheduled.json"
+WAITING_FILE = "waiting.json"
+OUTCOMES_FILE = "outcomes.json"
+BLOB_DIR = "blobs"
+JOURNAL_FILE = "journal.jsonl"
+JOURNAL_SEGMENT = "journal.{:020d}.jsonl"
+JOURNAL_CURSOR = "journal.{}.cursor"
+JOURNAL_SEGMENT_BYTES = 64 * 1024 * 1024
+JOURNAL_KEEP_SEGMENTS = 2
+COALESCE_FILE = "coalesce.json"
+CACHE_DIR = "cache"
+CACHE_STATS_FILE = os.path.join(CACHE_DIR, "stats.json")
+CACHE_MAX_ENTRIES = 10000
+CACHE_FLUSH_INTERVAL = 5
+CACHE_EVICT_INTERVAL = 60
+HOOKS_FILE = "hooks.json"
+OUTBOX_FILE = "outbox.json"
+HOOK_EVENTS = ("succeeded", "dead_lettered")
+HOOK_BATCH_SIZE = 50
+HOOK_BATCH_WAIT = 1.0
+HOOK_TIMEOUT = 5
+HOOK_BACKOFF_MAX = 300
+HOOK_POLL = 0.5
+OUTBOX_LIMIT = 10000
+JOURNAL_EVENTS = ("enqueued", "coalesced", "claimed", "succeeded", "failed", "retried", "dead_lettered",
+                  "ready", "released", "requeued")
+PARENT_FAILURE_POLICIES = ("fail", "run")
+CRON_FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+RETRY_STRATEGIES = ("exponential", "linear", "fixed")
+RETRY_JITTER = ("none", "full", "decorrelated")
+TIMEOUT_EXIT_CODE = 124
+WATCHDOG_MIN_SAMPLES = 20
+WATCHDOG_MIN_RUNTIME = 5
 stop_event = threading.Event()
 job_queue = queue.Queue()
 MAX_RETRIES=3
 DEFAULT_CONFIG = {
     "max_retries": 3,
     "backoff_base": 2,
-    "failure_rate": 0.4  
+    "backoff_max": 300,
+    "backoff_jitter": "full",
+    "failure_rate": 0.4,
+    "executor": "simulation",
+    "task_modules": "",
+    "prefork_queues": "",
+    "batch_max": 20,
+    "journal_fsync": 0,
+    "job_timeout": 0,
+    "kill_grace": 5,
+    "watchdog_percentile": 95,
+    "watchdog_factor": 3,
+    "autoscale_jobs_per_worker": 10,
+    "autoscale_max_age": 30,
+    "autoscale_max_cpu": 90,
+    "autoscale_up_cooldown": 15,
+    "autoscale_down_cooldown": 60,
+    "metrics_interval": 15,
+    "log_format": "text",
+    "log_level": "INFO",
+    "log_sample_rate": 1.0,
+    "log_file": ""
 }
 lock=FileLock("queue.json.lock")
+cache_lock = FileLock(f"{CACHE_DIR}.lock")
+logger = logging.getLogger("queuectl")
 def load_config():
     if not os.path.exists(CONFIG_FILE):
         save_config(DEFAULT_CONFIG)
         return DEFAULT_CONFIG
     try:
         with open(CONFIG_FILE, "r") as f:
-            return json.load(f)
+            return {**DEFAULT_CONFIG, **json.load(f)}
     except (json.JSONDecodeError, FileNotFoundError):
         return DEFAULT_CONFIG
 
-def save_config(config):
-    with open(CONFIG_FILE, "w") as f:
-        json.dump(config, f, indent=2)
-def load_jobs(file_path):
-    if not os.path.exists(file_path):
-        return []
-    with open(file_path, "r") as f:
+def save_config(config):
+    # Written to a temp file and renamed so running workers never read a
+    # half-written config.
+    tmp_path = f"{CONFIG_FILE}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(config, f, indent=2)
+    os.replace(tmp_path, CONFIG_FILE)
+
+def validate_config(config):
+    for key in ("max_retries", "backoff_base", "backoff_max", "failure_rate", "log_sample_rate",
+                "autoscale_jobs_per_worker", "autoscale_max_age", "autoscale_max_cpu",
+                "autoscale_up_cooldown", "autoscale_down_cooldown", "job_timeout", "kill_grace",
+                "watchdog_percentile", "watchdog_factor", "metrics_interval"):
+        if not isinstance(config.get(key), (int, float)) or config[key] < 0:
+            raise ValueError(f"{key} must be a non-negative number")
+    for key in ("failure_rate", "log_sample_rate"):
+        if config[key] > 1:
+            raise ValueError(f"{key} must be between 0 and 1")
+    if not isinstance(config.get("prefork_queues"), str):
+        raise ValueError("prefork_queues must be a comma-separated list of queues or *")
+    if not isinstance(config.get("task_modules"), str):
+        raise ValueError("task_modules must be a comma-separated list of modules")
+    if not isinstance(config.get("batch_max"), int) or config["batch_max"] < 1:
+        raise ValueError("batch_max must be a positive integer")
+    if config.get("journal_fsync") not in (0, 1):
+        raise ValueError("journal_fsync must be 0 or 1")
+    if config["watchdog_percentile"] > 100:
+        raise ValueError("watchdog_percentile must be between 0 and 100")
+    if config["autoscale_jobs_per_worker"] < 1:
+        raise ValueError("autoscale_jobs_per_worker must be at least 1")
+    if config.get("backoff_jitter") not in RETRY_JITTER:
+        raise ValueError(f"backoff_jitter must be one of {', '.join(RETRY_JITTER)}")
+    if config.get("executor") not in EXECUTORS:
+        raise ValueError(f"executor must be one of {', '.join(EXECUTORS)}")
+    if config.get("log_format") not in ("text", "json"):
+        raise ValueError("log_format must be text or json")
+    if not isinstance(logging.getLevelName(str(config.get("log_level")).upper()), int):
+        raise ValueError(f"unknown log_level: {config.get('log_level')}")
+
+
+class LiveConfig:
+    # Workers read .config once per job; the supervisor swaps in a new,
+    # validated dict when config.json changes. Rebinding the attribute is
+    # atomic, so readers always see either the old or the new config.
+    def __init__(self, config=None):
+        self.config = config or load_config()
+        self.mtime = self._mtime()
+
+    def _mtime(self):
+        try:
+            return os.stat(CONFIG_FILE).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def refresh(self):
+        mtime = self._mtime()
+        if mtime == self.mtime:
+            return False
+        self.mtime = mtime
+        try:
+            with open(CONFIG_FILE, "r") as f:
+                config = {**DEFAULT_CONFIG, **json.load(f)}
+            validate_config(config)
+        except (OSError, ValueError) as e:
+            log_event(logging.WARNING, f"Ignoring config change: {e}", outcome="config_rejected")
+            return False
+        self.config = config
+        update_logging(config)
+        log_event(logging.INFO, "Configuration reloaded.", outcome="config_reloaded")
+        return True
+def load_jobs(file_path):
+    if not os.path.exists(file_path):
+        return []
+    with open(file_path, "r") as f:
+        try:
+            return json.load(f)
+        except json.JSONDecodeError:
+            return []
+
+def save_jobs(file_path,jobs):
+    data = json.dumps(jobs, indent=2)
+    with open(file_path, "w") as f:
+        f.write(data)
+    return len(data)
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.utcfromtimestamp(record.created).strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+            "level": record.levelname,
+            "node": NODE_ID,
+            "msg": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        return json.dumps(entry)
+
+
+class SamplingFilter(logging.Filter):
+    # Warnings and errors are always kept; routine lines are sampled.
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+def setup_logging(config):
+    if config.get("log_file"):
+        handler = logging.FileHandler(config["log_file"])
+    else:
+        handler = logging.StreamHandler(sys.stdout)
+    if config.get("log_format") == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(message)s"))
+
+    # Workers only push records onto an unbounded queue; formatting and
+    # writing happen on the listener thread.
+    records = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(records)
+    queue_handler.addFilter(SamplingFilter(float(config.get("log_sample_rate", 1.0))))
+    logger.handlers = [queue_handler]
+    logger.setLevel(str(config.get("log_level", "INFO")).upper())
+    logger.propagate = False
+
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+    return listener
+
+def update_logging(config):
+    logger.setLevel(str(config.get("log_level", "INFO")).upper())
+    for handler in logger.handlers:
+        for log_filter in handler.filters:
+            if isinstance(log_filter, SamplingFilter):
+                log_filter.rate = float(config.get("log_sample_rate", 1.0))
+
+def log_event(level, message, **fields):
+    logger.log(level, message, extra={"fields": fields})
+
+def validate_retry_policy(policy):
+    if not isinstance(policy, dict):
+        raise ValueError("retry must be an object")
+    if policy.get("strategy", "exponential") not in RETRY_STRATEGIES:
+        raise ValueError(f"retry.strategy must be one of {', '.join(RETRY_STRATEGIES)}")
+    if policy.get("jitter", "none") not in RETRY_JITTER:
+        raise ValueError(f"retry.jitter must be one of {', '.join(RETRY_JITTER)}")
+    for key in ("base", "max_delay"):
+        value = policy.get(key)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0):
+            raise ValueError(f"retry.{key} must be a non-negative number")
+    retry_on = policy.get("retry_on", [])
+    if not isinstance(retry_on, list) or any(not isinstance(c, int) and c != "timeout" for c in retry_on):
+        raise ValueError('retry.retry_on must be a list of exit codes or "timeout"')
+
+def job_fingerprint(job):
+    # Everything that decides what a job runs, and nothing about this attempt.
+    spec = {key: job.get(key) for key in ("command", "args", "env", "cwd", "stdin", "task", "kwargs")}
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+def load_coalesce():
+    if not os.path.exists(COALESCE_FILE):
+        return {}
+    with open(COALESCE_FILE, "r") as f:
+        try:
+            return json.load(f)
+        except json.JSONDecodeError:
+            return {}
+
+def save_coalesce(index):
+    with open(COALESCE_FILE, "w") as f:
+        json.dump(index, f)
+
+cache_counts = {"hits": 0, "misses": 0, "flushed": 0.0, "evicted": 0.0}
+cache_counts_lock = threading.Lock()
+
+def cache_path(fingerprint):
+    # One file per fingerprint, so a lookup reads one small file and takes no
+    # lock. Its mtime is the last use.
+    return os.path.join(CACHE_DIR, f"{fingerprint}.json")
+
+def cache_entry_names():
+    return [name for name in os.listdir(CACHE_DIR) if name.endswith(".json") and name != "stats.json"]
+
+def load_cache_stats():
+    if not os.path.exists(CACHE_STATS_FILE):
+        return {"hits": 0, "misses": 0}
+    with open(CACHE_STATS_FILE, "r") as f:
+        try:
+            return json.load(f)
+        except json.JSONDecodeError:
+            return {"hits": 0, "misses": 0}
+
+def load_cache():
+    if not os.path.isdir(CACHE_DIR):
+        return None
+    cache = load_cache_stats()
+    cache["entries"] = len(cache_entry_names())
+    return cache
+
+def flush_cache_counts():
+    with cache_counts_lock:
+        hits, misses = cache_counts["hits"], cache_counts["misses"]
+        cache_counts.update(hits=0, misses=0, flushed=time.time())
+    if not hits and not misses:
+        return
+    with cache_lock:
+        stats = load_cache_stats()
+        stats["hits"] += hits
+        stats["misses"] += misses
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = f"{CACHE_STATS_FILE}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(stats, f)
+        os.replace(tmp_path, CACHE_STATS_FILE)
+
+atexit.register(flush_cache_counts)
+
+def count_cache(outcome):
+    # Hits and misses add up in memory and reach stats.json every few seconds.
+    with cache_counts_lock:
+        cache_counts[outcome] += 1
+        due = time.time() - cache_counts["flushed"] >= CACHE_FLUSH_INTERVAL
+    if due:
+        flush_cache_counts()
+
+def write_cache_entry(fingerprint, entry):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = cache_path(fingerprint)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(entry, f)
+    os.replace(tmp_path, path)
+
+def evict_cache(now):
+    # Drops expired entries, then the least recently used, to stay bounded.
+    # Each process scans the directory at most once per CACHE_EVICT_INTERVAL.
+    with cache_counts_lock:
+        if now - cache_counts["evicted"] < CACHE_EVICT_INTERVAL:
+            return
+        cache_counts["evicted"] = now
+    live = []
+    for name in cache_entry_names():
+        path = os.path.join(CACHE_DIR, name)
+        try:
+            with open(path, "r") as f:
+                expires = json.load(f)["expires"]
+            used = os.stat(path).st_mtime
+        except (OSError, ValueError, KeyError):
+            continue
+        if expires <= now:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+        else:
+            live.append((used, path))
+    live.sort()
+    for _, path in live[:max(0, len(live) - CACHE_MAX_ENTRIES)]:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+
+def build_job(user_job):
+    now = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+    job = {
+        "id": user_job.get("id"),
+        "command": user_job.get("command"),
+        "queue": user_job.get("queue", "default"),
+        "tag": user_job.get("tag", user_job.get("type")),
+        "state": "pending",
+        "attempts": 0,
+        "max_retries": user_job.get("max_retries"),
+        "created_at": now,
+        "updated_at": now
+    }
+    max_retries = user_job.get("max_retries")
+    if max_retries is not None and (isinstance(max_retries, bool) or not isinstance(max_retries, int) or max_retries < 0):
+        raise ValueError("max_retries must be a non-negative integer")
+    if user_job.get("retry") is not None:
+        validate_retry_policy(user_job["retry"])
+        job["retry"] = user_job["retry"]
+    if user_job.get("timeout") is not None:
+        if not isinstance(user_job["timeout"], (int, float)) or user_job["timeout"] <= 0:
+            raise ValueError("timeout must be a positive number of seconds")
+        job["timeout"] = user_job["timeout"]
+    if user_job.get("notify") is not None:
+        if not str(user_job["notify"]).startswith(("http://", "https://")):
+            raise ValueError("notify must be an http(s) URL")
+        job["notify"] = user_job["notify"]
+    owner = user_job.get("owner", user_job.get("tenant"))
+    if owner is not None:
+        if not isinstance(owner, str) or not owner:
+            raise ValueError("owner must be a non-empty string")
+        job["owner"] = owner
+    if user_job.get("batchable"):
+        job["batchable"] = True
+    if user_job.get("coalesce_key") is not None:
+        if not isinstance(user_job["coalesce_key"], str) or not user_job["coalesce_key"]:
+            raise ValueError("coalesce_key must be a non-empty string")
+        job["coalesce_key"] = user_job["coalesce_key"]
+    if user_job.get("cache_ttl") is not None:
+        if not isinstance(user_job["cache_ttl"], (int, float)) or user_job["cache_ttl"] <= 0:
+            raise ValueError("cache_ttl must be a positive number of seconds")
+        job["cache_ttl"] = user_job["cache_ttl"]
+    if user_job.get("task") is not None:
+        if not isinstance(user_job["task"], str):
+            raise ValueError('task must be a registered name or "module:function"')
+        if not isinstance(user_job.get("kwargs", {}), dict):
+            raise ValueError("kwargs must be an object")
+        job["task"] = user_job["task"]
+        job["kwargs"] = user_job.get("kwargs", {})
+        if job["command"] is None:
+            job["command"] = f"task:{job['task']}"
+    if user_job.get("args") is not None:
+        args = user_job["args"]
+        if not isinstance(args, list) or not args or not all(isinstance(a, str) for a in args):
+            raise ValueError("args must be a non-empty list of strings")
+        job["args"] = args
+        if job["command"] is None:
+            # Only for display and prefix: limits; args are what runs.
+            job["command"] = shlex.join(args)
+    if user_job.get("env") is not None:
+        env = user_job["env"]
+        if not isinstance(env, dict) or not all(isinstance(k, str) and isinstance(v, str) for k, v in env.items()):
+            raise ValueError("env must map variable names to strings")
+        job["env"] = env
+    for key in ("cwd", "stdin"):
+        if user_job.get(key) is not None:
+            if not isinstance(user_job[key], str):
+                raise ValueError(f"{key} must be a string")
+            job[key] = user_job[key]
+    if job.get("cache_ttl"):
+        job["fingerprint"] = job_fingerprint(job)
+    if user_job.get("depends_on"):
+        if not isinstance(user_job["depends_on"], list):
+            raise ValueError("depends_on must be a list of job IDs")
+        if user_job.get("on_parent_failure", "fail") not in PARENT_FAILURE_POLICIES:
+            raise ValueError(f"on_parent_failure must be one of {', '.join(PARENT_FAILURE_POLICIES)}")
+        job["depends_on"] = user_job["depends_on"]
+        job["on_parent_failure"] = user_job.get("on_parent_failure", "fail")
+    return job
+
+
+EXEC_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+LOCK_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+PROFILE_BUFFER = 10000
+PROFILE_PHASES = ("lock", "load", "mutate", "save", "exec")
+# From 3.12 cProfile hooks sys.monitoring, which sees every thread but allows
+# only one active profiler; before that each thread needs its own.
+PROFILE_ALL_THREADS = sys.version_info >= (3, 12)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.sum += value
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+
+    def quantile(self, q, counts=None):
+        # Upper bound of the bucket holding the q-th quantile; None past the last bucket.
+        counts = counts or self.counts
+        rank = q * sum(counts)
+        seen = 0
+        for bound, count in zip(self.buckets, counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+
+class WorkerStats:
+    # Owned by a single worker thread, so updates need no locking.
+    def __init__(self, worker_id, samples=False, profile=False):
+        self.worker_id = worker_id
+        self.claimed = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.dead_lettered = 0
+        self.retried = 0
+        self.timed_out = 0
+        self.bytes_written = 0
+        self.exec_duration = Histogram(EXEC_BUCKETS)
+        self.lock_wait_duration = Histogram(LOCK_BUCKETS)
+        self.samples = samples
+        self.lock_wait = []
+        self.claim_latency = []
+        self.finished_at = {}
+        self.phases = deque(maxlen=PROFILE_BUFFER) if profile else None
+        self.profiler = None
+        self.current_job = None
+        self.in_flight = []
+        self.job_started = None
+        self.last_seen = time.time()
+        # Taken by the worker around claims and acks, and by the supervisor
+        # when it gives up on a drain and takes the worker's job back.
+        self.ack_lock = threading.Lock()
+        self.abandoned = False
+        self.thread_id = None
+
+    def snapshot(self):
+        # Registry record published with the node lease.
+        attempts = self.succeeded + self.failed
+        executed = sum(self.exec_duration.counts)
+        job = self.current_job
+        return {
+            "worker": self.worker_id,
+            "job": job.get("id") if job else None,
+            "batch": len(self.in_flight),
+            "job_started": self.job_started if job else None,
+            "done": self.succeeded + self.dead_lettered,
+            "failure_rate": round(self.failed / attempts, 4) if attempts else 0.0,
+            "avg_exec": round(self.exec_duration.sum / executed, 6) if executed else 0.0,
+            "last_seen": self.last_seen,
+        }
+
+    def delta(self):
+        return {"claimed": self.claimed, "succeeded": self.succeeded, "failed": self.failed,
+                "dead_lettered": self.dead_lettered, "retried": self.retried,
+                "bytes_written": self.bytes_written, "lock_wait": self.lock_wait}
+
+    def merge(self, delta):
+        # Folds in the counters a queue server recorded for one request.
+        for key in ("claimed", "succeeded", "failed", "dead_lettered", "retried", "bytes_written"):
+            setattr(self, key, getattr(self, key) + delta.get(key, 0))
+        for seconds in delta.get("lock_wait", []):
+            self.record_lock_wait(seconds)
+
+    def record_lock_wait(self, seconds):
+        self.lock_wait_duration.observe(seconds)
+        if self.samples:
+            self.lock_wait.append(seconds)
+
+    def record_claim(self, seconds):
+        self.claimed += 1
+        if self.samples:
+            self.claim_latency.append(seconds)
+
+    def record_finish(self, job_id):
+        if self.samples:
+            self.finished_at[job_id] = time.perf_counter()
+
+
+def mark_phase(stats, phase, start):
+    now = time.perf_counter()
+    if stats is not None and stats.phases is not None:
+        stats.phases.append((phase, start, now - start))
+    return now
+
+
+def load_limits():
+    if not os.path.exists(LIMITS_FILE):
+        return {}
+    with open(LIMITS_FILE, "r") as f:
+        try:
+            return json.load(f)
+        except json.JSONDecodeError:
+            return {}
+
+def load_limit_state():
+    if not os.path.exists(LIMITS_STATE_FILE):
+        return {}
+    with open(LIMITS_STATE_FILE, "r") as f:
+        try:
+            return json.load(f)
+        except json.JSONDecodeError:
+            return {}
+
+def save_limit_state(state):
+    with open(LIMITS_STATE_FILE, "w") as f:
+        json.dump(state, f)
+
+def matching_limits(job, rules):
+    keys = []
+    for key in rules:
+        kind, _, value = key.partition(":")
+        if kind == "queue" and job.get("queue", "default") == value:
+            keys.append(key)
+        elif kind == "tag" and job.get("tag") == value:
+            keys.append(key)
+        elif kind == "prefix" and (job.get("command") or "").startswith(value):
+            keys.append(key)
+    return keys
+
+def limit_has_capacity(rule, state, now):
+    if rule.get("max_in_flight") is not None and state["in_flight"] >= rule["max_in_flight"]:
+        return False
+    if rule.get("rate") is not None:
+        burst = rule.get("burst") or max(1, rule["rate"])
+        state["tokens"] = min(burst, state["tokens"] + (now - state["updated"]) * rule["rate"])
+        state["updated"] = now
+        if state["tokens"] < 1:
+            return False
+    return True
+
+def acquire_limited_job(jobs, rules, state, now, indices=None):
+    # Returns the index of the first job whose classes all have capacity and
+    # charges it against them. Throttled jobs stay where they are in the queue.
+    blocked = set()
+    for index in range(len(jobs)) if indices is None else indices:
+        job = jobs[index]
+        keys = matching_limits(job, rules)
+        if any(key in blocked for key in keys):
+            continue
+        for key in keys:
+            rule = rules[key]
+            key_state = state.setdefault(key, {"tokens": rule.get("burst") or rule.get("rate") or 0,
+                                               "updated": now, "in_flight": 0})
+            if not limit_has_capacity(rule, key_state, now):
+                blocked.add(key)
+                break
+        else:
+            for key in keys:
+                state[key]["in_flight"] += 1
+                if rules[key].get("rate") is not None:
+                    state[key]["tokens"] -= 1
+            return index
+    return None
+
+def hold_charge(holders, node):
+    holders[node] = holders.get(node, 0) + 1
+
+def drop_charge(holders, node):
+    # False when the charge was already reclaimed, e.g. from a node whose
+    # lease lapsed while it was still running.
+    if node is None:
+        return True
+    if not holders.get(node):
+        return False
+    holders[node] -= 1
+    if not holders[node]:
+        del holders[node]
+    return True
+
+def hold_limits(state, rules, jobs, node):
+    # Every in-flight slot records the node holding it so a dead node's
+    # slots can be reclaimed.
+    for job in jobs:
+        for key in matching_limits(job, rules):
+            hold_charge(state[key].setdefault("nodes", {}), node)
+
+def release_limits(jobs):
+    rules = load_limits()
+    if not rules:
+        return
+    state = load_limit_state()
+    for job in jobs:
+        for key in matching_limits(job, rules):
+            if key in state and drop_charge(state[key].setdefault("nodes", {}), job.get("claimed_by")):
+                state[key]["in_flight"] = max(0, state[key]["in_flight"] - 1)
+    save_limit_state(state)
+
+def reclaim_limits(live):
+    # Caller must hold the lock. Frees the slots of nodes without a live lease.
+    state = load_limit_state()
+    freed = Counter()
+    for key_state in state.values():
+        for node in [n for n in key_state.get("nodes", {}) if n not in live]:
+            count = key_state["nodes"].pop(node)
+            key_state["in_flight"] = max(0, key_state["in_flight"] - count)
+            freed[node] += count
+    if freed:
+        save_limit_state(state)
+        for node, count in freed.items():
+            log_event(logging.WARNING, f"Reclaimed {count} limit slot(s) held by dead node {node}.",
+                      outcome="reclaimed", node=node)
+
+
+class QuotaExceeded(ValueError):
+    pass
+
+def job_owner(job):
+    return job.get("owner") or "default"
+
+def load_tenants():
+    if not os.path.exists(TENANTS_FILE):
+        return {}
+    with open(TENANTS_FILE, "r") as f:
+        try:
+            return json.load(f)
+        except json.JSONDecodeError:
+            return {}
+
+def load_tenant_state():
+    # None until the first owned job or tenant rule; until then claims stay FIFO.
+    if not os.path.exists(TENANTS_STATE_FILE):
+        return None
+    with open(TENANTS_STATE_FILE, "r") as f:
+        try:
+            return json.load(f)
+        except json.JSONDecodeError:
+            return None
+
+def save_tenant_state(state):
+    with open(TENANTS_STATE_FILE, "w") as f:
+        json.dump(state, f)
+
+def new_tenant_state(queued):
+    state = {"ring": [], "next": 0, "seq": 0, "deficit": {}, "queues": {}, "running": {}, "nodes": {}}
+    count_pending(state, queued)
+    return state
+
+def count_pending(state, jobs):
+    # Jobs are numbered in queue order and each owner keeps a FIFO of its
+    # numbers. Owners are in the ring exactly while they have pending jobs.
+    for job in jobs:
+        owner = job_owner(job)
+        job["seq"] = state["seq"]
+        state["seq"] += 1
+        if not state["queues"].get(owner):
+            state["ring"].append(owner)
+        state["queues"].setdefault(owner, []).append(job["seq"])
+
+def find_queued(jobs, seq):
+    # queue.json only ever appends and removes, so it stays sorted by seq.
+    index = bisect.bisect_left(jobs, seq, key=lambda job: job.get("seq", -1))
+    return index if index < len(jobs) and jobs[index].get("seq") == seq else None
+
+def drop_owner(state, owner):
+    index = state["ring"].index(owner)
+    state["ring"].pop(index)
+    state["queues"].pop(owner, None)
+    state["deficit"].pop(owner, None)
+    if state["next"] > index:
+        state["next"] -= 1
+
+def track_pending(queued, jobs):
+    # Caller must hold the lock; `queued` is the queue before `jobs` are added.
+    state = load_tenant_state()
+    if state is None:
+        if not any(job.get("owner") for job in jobs) and not load_tenants():
+            return
+        state = new_tenant_state(queued)
+    count_pending(state, jobs)
+    save_tenant_state(state)
+
+def check_tenant_quota(jobs):
+    # Caller must hold the lock.
+    tenants = load_tenants()
+    if not any(rule.get("max_pending") is not None for rule in tenants.values()):
+        return
+    state = load_tenant_state() or {"queues": {}}
+    # Accepted one-off delayed jobs count as pending; they skip the check when they fire.
+    delayed = Counter(job_owner(e["job"]) for e in load_jobs(SCHEDULE_FILE) if e["id"].startswith("once:"))
+    for owner, count in Counter(job_owner(job) for job in jobs).items():
+        max_pending = tenants.get(owner, {}).get("max_pending")
+        pending = len(state["queues"].get(owner, [])) + delayed[owner]
+        if max_pending is not None and pending + count > max_pending:
+            raise QuotaExceeded(f"owner '{owner}' has {pending} pending job(s); max_pending is {max_pending}")
+
+def fair_claim(jobs, state, tenants, rules, limit_state, now, limit=1):
+    # Deficit round robin over owners with pending jobs: arriving at an owner
+    # credits its weight, each claimed job costs one, and the turn passes once
+    # the credit is spent. Owners at max_running are passed over. A decision
+    # visits at most every owner once and finds each owner's head through its
+    # own FIFO, however long the queue is.
+    ring = state["ring"]
+    for _ in range(len(ring)):
+        if not ring:
+            break
+        pos = state["next"] % len(ring)
+        state["next"] = pos
+        owner = ring[pos]
+        tenant = tenants.get(owner, {})
+        running = state["running"].get(owner, 0)
+        room = limit
+        if tenant.get("max_running") is not None:
+            room = min(room, tenant["max_running"] - running)
+        if room < 1:
+            state["next"] = pos + 1
+            continue
+        queued = state["queues"][owner]
+        while queued and find_queued(jobs, queued[0]) is None:
+            # The job left the queue some other way, e.g. it was edited out.
+            queued.pop(0)
+        if rules:
+            indices = (i for i in (find_queued(jobs, seq) for seq in queued) if i is not None)
+            first = acquire_limited_job(jobs, rules, limit_state, now, indices)
+        else:
+            first = find_queued(jobs, queued[0]) if queued else None
+        if first is None:
+            if queued:
+                state["next"] = pos + 1
+            else:
+                # The counts were stale, e.g. after jobs were cancelled.
+                drop_owner(state, owner)
+            continue
+        deficit = state["deficit"].get(owner, 0)
+        if deficit < 1:
+            deficit += tenant.get("weight", 1)
+        picked = [first]
+        key = batch_key(jobs[first])
+        if key and not rules:
+            for seq in queued[1:]:
+                if len(picked) >= min(room, int(deficit)):
+                    break
+                i = find_queued(jobs, seq)
+                if i is not None and batch_key(jobs[i]) == key:
+                    picked.append(i)
+        state["deficit"][owner] = deficit - len(picked)
+        state["running"][owner] = running + len(picked)
+        taken = {jobs[i]["seq"] for i in picked}
+        queued[:] = [seq for seq in queued if seq not in taken]
+        if not queued:
+            drop_owner(state, owner)
+        elif deficit - len(picked) < 1:
+            state["next"] = pos + 1
+        return picked
+    return []
+
+def hold_tenants(state, jobs, node):
+    # Running counts are also kept per node, so a dead node's can be reclaimed.
+    holders = state.setdefault("nodes", {})
+    for job in jobs:
+        hold_charge(holders.setdefault(node, {}), job_owner(job))
+
+def release_tenants(jobs):
+    state = load_tenant_state()
+    if state is None:
+        return
+    holders = state.setdefault("nodes", {})
+    for job in jobs:
+        owner = job_owner(job)
+        node = job.get("claimed_by")
+        if node is not None and not drop_charge(holders.get(node, {}), owner):
+            continue
+        if node is not None and not holders[node]:
+            del holders[node]
+        state["running"][owner] = max(0, state["running"].get(owner, 0) - 1)
+    save_tenant_state(state)
+
+def reclaim_tenants(live):
+    # Caller must hold the lock. Frees the running slots of nodes without a live lease.
+    state = load_tenant_state()
+    if state is None:
+        return
+    dead = [node for node in state.get("nodes", {}) if node not in live]
+    for node in dead:
+        for owner, count in state["nodes"].pop(node).items():
+            state["running"][owner] = max(0, state["running"].get(owner, 0) - count)
+        log_event(logging.WARNING, f"Reclaimed running slots held by dead node {node}.",
+                  outcome="reclaimed", node=node)
+    if dead:
+        save_tenant_state(state)
+
+def release_claims(jobs):
+    release_limits(jobs)
+    release_tenants(jobs)
+
+def reclaim_claims(live):
+    reclaim_limits(live)
+    reclaim_tenants(live)
+
+
+def load_waiting():
+    if not os.path.exists(WAITING_FILE):
+        return {"jobs": {}, "children": {}}
+    with open(WAITING_FILE, "r") as f:
+        try:
+            return json.load(f)
+        except json.JSONDecodeError:
+            return {"jobs": {}, "children": {}}
+
+def save_waiting(index):
+    with open(WAITING_FILE, "w") as f:
+        json.dump(index, f, indent=2)
+
+def load_outcomes():
+    # Caller must hold the lock. Finished job IDs mapped to "succeeded" or
+    # "dead", so dependency checks look parents up instead of reading job
+    # history. Built from the job files the first time it is needed.
+    if not os.path.exists(OUTCOMES_FILE):
+        outcomes = {job.get("id"): "succeeded" for job in load_jobs(PROCESSED_FILE)}
+        outcomes.update((job.get("id"), "dead") for job in load_jobs(FAILED_FILE))
+        save_outcomes(outcomes)
+        return outcomes
+    with open(OUTCOMES_FILE, "r") as f:
+        try:
+            return json.load(f)
+        except json.JSONDecodeError:
+            return {}
+
+def save_outcomes(outcomes):
+    with open(OUTCOMES_FILE, "w") as f:
+        json.dump(outcomes, f)
+
+def record_outcomes(jobs, outcome):
+    # Caller must hold the lock.
+    outcomes = load_outcomes()
+    outcomes.update((job.get("id"), outcome) for job in jobs if job.get("id") is not None)
+    save_outcomes(outcomes)
+
+def check_workflow(jobs):
+    ids = [job.get("id") for job in jobs]
+    if len(set(ids)) != len(ids):
+        raise ValueError("job IDs in a workflow must be unique")
+    # Kahn's algorithm over the edges inside this batch.
+    batch = set(ids)
+    remaining = {job["id"]: {p for p in job.get("depends_on") or [] if p in batch} for job in jobs}
+    ready = [job_id for job_id, parents in remaining.items() if not parents]
+    while ready:
+        done = ready.pop()
+        for job_id, parents in remaining.items():
+            if done in parents:
+                parents.discard(done)
+                if not parents:
+                    ready.append(job_id)
+        remaining.pop(done)
+    if remaining:
+        raise ValueError(f"dependency cycle between: {', '.join(sorted(remaining))}")
+
+def check_parents(jobs, index=None, outcomes=None):
+    # Caller must hold the lock. Parents that have finished, are waiting or
+    # come in the same batch are found in the indexes; only the rest need
+    # the queue and the schedule.
+    index = index if index is not None else load_waiting()
+    outcomes = outcomes if outcomes is not None else load_outcomes()
+    known = set(index["jobs"]) | {job.get("id") for job in jobs}
+    if any(p not in known and p not in outcomes for job in jobs for p in job.get("depends_on") or []):
+        known.update(job.get("id") for job in load_jobs(QUEUE_FILE))
+        known.update(entry["id"] if entry.get("cron") else entry["job"].get("id") for entry in load_jobs(SCHEDULE_FILE))
+    for job in jobs:
+        parents = job.get("depends_on") or []
+        unknown = [p for p in parents if p not in known and p not in outcomes]
+        if unknown:
+            raise ValueError(f"job {job.get('id')} depends on unknown job(s): {', '.join(unknown)}")
+
+def add_waiting_jobs(jobs):
+    # Caller must hold the lock. Returns (ready, failed) jobs.
+    check_workflow(jobs)
+    index = load_waiting()
+    outcomes = load_outcomes()
+    check_parents(jobs, index, outcomes)
+
+    ready = []
+    for job in jobs:
+        waiting_on = [p for p in job.get("depends_on") or [] if outcomes.get(p) != "succeeded"]
+        if not waiting_on:
+            ready.append(job)
+            continue
+        job["state"] = "waiting"
+        job["waiting_on"] = waiting_on
+        index["jobs"][job["id"]] = job
+        for parent in waiting_on:
+            index["children"].setdefault(parent, []).append(job["id"])
+
+    failed = []
+    dead = dict.fromkeys(p for job in jobs for p in job.get("depends_on") or [] if outcomes.get(p) == "dead")
+    for parent in dead:
+        if parent in index["children"]:
+            released, cascaded = resolve_in_index(index, parent, False)
+            ready.extend(released)
+            failed.extend(cascaded)
+    save_waiting(index)
+    return ready, failed
+
+def resolve_in_index(index, parent_id, succeeded):
+    released, failed = [], []
+    stack = [(parent_id, succeeded)]
+    while stack:
+        parent, ok = stack.pop()
+        for child_id in index["children"].pop(parent, []):
+            child = index["jobs"].get(child_id)
+            if child is None:
+                continue
+            if ok or child.get("on_parent_failure") == "run":
+                child["waiting_on"].remove(parent)
+                if not child["waiting_on"]:
+                    del index["jobs"][child_id]
+                    del child["waiting_on"]
+                    child["state"] = "pending"
+                    released.append(child)
+            else:
+                del index["jobs"][child_id]
+                child["state"] = "failed"
+                child["error"] = f"dependency {parent} failed"
+                failed.append(child)
+                stack.append((child_id, False))
+    return released, failed
+
+def resolve_dependents(parent_id, succeeded):
+    # Caller must hold the lock. Only the waiting index is touched, never
+    # processed.json, so finishing a job with no dependents costs one stat().
+    if not os.path.exists(WAITING_FILE):
+        return [], []
+    index = load_waiting()
+    if parent_id not in index["children"]:
+        return [], []
+    released, failed = resolve_in_index(index, parent_id, succeeded)
+    save_waiting(index)
+    return released, failed
+
+
+def journal_record(job, event, state=None):
+    record = {"ts": time.time(), "id": job.get("id"), "event": event,
+              "state": state or job.get("state"), "queue": job.get("queue"), "command": job.get("command")}
+    if job.get("notify"):
+        record["notify"] = job["notify"]
+    if event in ("failed", "retried", "dead_lettered") and "exit_code" in job:
+        record["attempts"] = job.get("retries", 0)
+        record["exit_code"] = job["exit_code"]
+        if job.get("timed_out"):
+            record["timed_out"] = True
+    return record
+
+class JournalCompacted(ValueError):
+    pass
+
+def journal_segments():
+    # [(base, path)] oldest first. Offsets stay global across segments: a
+    # segment's base is the number of bytes logged before it. Only the last
+    # segment is appended to; rotated ones never change until deleted.
+    segments = []
+    for name in os.listdir("."):
+        if name == JOURNAL_FILE:
+            # Written before the log was segmented.
+            segments.append((0, name))
+        elif name.startswith("journal.") and name.endswith(".jsonl") and name[8:-6].isdigit():
+            segments.append((int(name[8:-6]), name))
+    return sorted(segments)
+
+def journal_append(records, fsync=False):
+    # Caller must hold the lock, which keeps offsets in commit order.
+    if not records:
+        return 0
+    data = "".join(json.dumps(record) + "\n" for record in records)
+    segments = journal_segments()
+    base, path = segments[-1] if segments else (0, JOURNAL_SEGMENT.format(0))
+    size = os.path.getsize(path) if segments else 0
+    if size >= JOURNAL_SEGMENT_BYTES:
+        base, path = base + size, JOURNAL_SEGMENT.format(base + size)
+        compact_journal(segments, base)
+    with open(path, "a") as f:
+        f.write(data)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    return len(data)
+
+def journal_low_water(active_base):
+    # The oldest offset anyone still needs: the hook outbox and any live
+    # follower (status --watch, list/events --follow) publishing a cursor.
+    low_water = active_base
+    if os.path.exists(OUTBOX_FILE):
+        low_water = min(low_water, load_outbox()["offset"])
+    for name in os.listdir("."):
+        if not (name.startswith("journal.") and name.endswith(".cursor")):
+            continue
+        try:
+            if psutil.pid_exists(int(name[8:-7])):
+                with open(name) as f:
+                    low_water = min(low_water, int(f.read() or active_base))
+            else:
+                os.remove(name)
+        except (ValueError, OSError):
+            continue
+    return low_water
+
+def compact_journal(segments, active_base):
+    # Caller must hold the lock. Runs only when a segment rotates. The newest
+    # rotated segments are always kept for `events --from` consumers that
+    # checkpoint on their own.
+    low_water = journal_low_water(active_base)
+    for (_, path), (end, _) in zip(segments[:-JOURNAL_KEEP_SEGMENTS], segments[1:]):
+        if end > low_water:
+            break
+        os.remove(path)
+
+def publish_journal_cursor(offset):
+    path = JOURNAL_CURSOR.format(os.getpid())
+    if not os.path.exists(path):
+        atexit.register(lambda: os.path.exists(path) and os.remove(path))
+    with open(path, "w") as f:
+        f.write(str(offset))
+
+def journal_offset():
+    segments = journal_segments()
+    if not segments:
+        return 0
+    base, path = segments[-1]
+    try:
+        return base + os.path.getsize(path)
+    except FileNotFoundError:
+        return journal_offset()
+
+def read_journal_entries(offset=0):
+    # Returns (next_offset, record) for each complete record after `offset`;
+    # a line still being written is left for the next call.
+    segments = journal_segments()
+    if segments and offset < segments[0][0]:
+        raise JournalCompacted(f"offset {offset} was compacted; the oldest available is {segments[0][0]}")
+    entries = []
+    for i, (base, path) in enumerate(segments):
+        if i + 1 < len(segments) and segments[i + 1][0] <= offset:
+            continue
+        try:
+            with open(path, "rb") as f:
+                f.seek(offset - base)
+                data = f.read()
+        except FileNotFoundError:
+            break
+        for line in data[:data.rfind(b"\n") + 1].splitlines(keepends=True):
+            offset += len(line)
+            entries.append((offset, json.loads(line)))
+    return entries
+
+def read_journal(offset=0):
+    entries = read_journal_entries(offset)
+    return [record for _, record in entries], entries[-1][0] if entries else offset
+
+def iter_events(offset=0, follow=False, events=None, poll=0.5):
+    # Yields (next_offset, record) in commit order. Pass next_offset back in
+    # to resume right after that record.
+    segments = journal_segments()
+    if segments and offset < segments[0][0]:
+        raise JournalCompacted(f"offset {offset} was compacted; the oldest available is {segments[0][0]}")
+    if offset and offset not in (base for base, _ in segments):
+        segments = [segment for segment in segments if segment[0] < offset]
+        if not segments:
+            raise ValueError(f"offset {offset} is not a record boundary")
+        base, path = segments[-1]
+        with open(path, "rb") as f:
+            f.seek(offset - base - 1)
+            if f.read(1) != b"\n":
+                raise ValueError(f"offset {offset} is not a record boundary")
+    while True:
+        entries = read_journal_entries(offset)
+        for offset, record in entries:
+            if events is None or record["event"] in events:
+                yield offset, record
+        if not follow:
+            return
+        publish_journal_cursor(offset)
+        if not entries:
+            time.sleep(poll)
+
+
+def load_hooks():
+    if not os.path.exists(HOOKS_FILE):
+        return {}
+    with open(HOOKS_FILE, "r") as f:
+        try:
+            return json.load(f)
+        except json.JSONDecodeError:
+            return {}
+
+def load_outbox():
+    if not os.path.exists(OUTBOX_FILE):
+        # Start from the end of the log; history is not replayed to new hooks.
+        return {"offset": journal_offset(), "pending": {}}
+    with open(OUTBOX_FILE, "r") as f:
+        return json.load(f)
+
+def save_outbox(outbox):
+    tmp_path = f"{OUTBOX_FILE}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(outbox, f)
+    os.replace(tmp_path, OUTBOX_FILE)
+
+def hook_targets(hooks, record):
+    # Returns the URLs a journal record should be sent to, each once.
+    targets = []
+    for hook in hooks.values():
+        if record["event"] in hook.get("events", HOOK_EVENTS) and hook.get("queue") in (None, record.get("queue")):
+            targets.append(hook["url"])
+    if record.get("notify") and record["event"] in HOOK_EVENTS:
+        targets.append(record["notify"])
+    return dict.fromkeys(targets)
+
+def post_events(url, events):
+    try:
+        request = urllib.request.Request(url, data=json.dumps({"events": events}).encode(),
+                                         headers={"Content-Type": "application/json"}, method="POST")
+        with urllib.request.urlopen(request, timeout=HOOK_TIMEOUT) as response:
+            return 200 <= response.status < 300, None
+    except (urllib.error.URLError, OSError, http.client.HTTPException, ValueError) as e:
+        # HTTPException covers malformed replies; ValueError a bad URL.
+        return False, e
+
+
+class HookDispatcher:
+    # Follows the journal and POSTs batches of matching events to hook URLs
+    # from its own thread, so a slow endpoint never delays workers. The
+    # journal offset and undelivered batches are saved together in the
+    # outbox, giving at-least-once delivery; receivers can dedupe on `offset`.
+    def __init__(self):
+        self.outbox = None
+
+    def tick(self, now=None):
+        now = now or time.time()
+        pending = self.outbox["pending"]
+        hooks = load_hooks()
+        settings = {hook["url"]: hook for hook in hooks.values()}
+        try:
+            entries = read_journal_entries(self.outbox["offset"])
+        except JournalCompacted as e:
+            log_event(logging.WARNING, f"Hook dispatcher skipped compacted events: {e}", outcome="hook_dropped")
+            self.outbox["offset"] = journal_segments()[0][0]
+            entries = read_journal_entries(self.outbox["offset"])
+        if entries:
+            for offset, record in entries:
+                for url in hook_targets(hooks, record):
+                    box = pending.setdefault(url, {"events": [], "attempts": 0, "next_try": 0})
+                    box["events"].append({"offset": offset, **record})
+                    if len(box["events"]) > OUTBOX_LIMIT:
+                        del box["events"][0]
+                        log_event(logging.WARNING, f"Outbox for {url} is full, dropped its oldest event.",
+                                  outcome="hook_dropped", url=url)
+            self.outbox["offset"] = entries[-1][0]
+
+        changed = bool(entries)
+        for url, box in list(pending.items()):
+            if not box["events"]:
+                del pending[url]
+                changed = True
+                continue
+            hook = settings.get(url, {})
+            batch_size = hook.get("batch_size") or HOOK_BATCH_SIZE
+            batch_wait = hook.get("batch_wait", HOOK_BATCH_WAIT)
+            if now < box["next_try"]:
+                continue
+            if len(box["events"]) < batch_size and now - box["events"][0]["ts"] < batch_wait:
+                continue
+            batch = box["events"][:batch_size]
+            delivered, error = post_events(url, batch)
+            if delivered:
+                del box["events"][:len(batch)]
+                box["attempts"] = 0
+                box["next_try"] = 0
+            else:
+                box["attempts"] += 1
+                delay = min(2 ** box["attempts"], HOOK_BACKOFF_MAX)
+                box["next_try"] = now + delay
+                log_event(logging.WARNING, f"Hook delivery to {url} failed ({error or 'bad status'}), retrying in {delay}s.",
+                          outcome="hook_failed", url=url, attempt=box["attempts"], backoff=delay)
+            changed = True
+        if changed:
+            save_outbox(self.outbox)
+
+    def run(self, stop):
+        # One dispatcher per storage directory; others wait for its lock.
+        leader = FileLock(f"{OUTBOX_FILE}.lock")
+        while not stop.is_set():
+            try:
+                leader.acquire(timeout=0)
+            except Timeout:
+                stop.wait(5)
+                continue
+            try:
+                self.outbox = load_outbox()
+                while not stop.is_set():
+                    try:
+                        self.tick()
+                    except Exception as e:
+                        # Keep delivering to the other hooks; the outbox is retried next tick.
+                        log_event(logging.ERROR, f"Hook dispatcher error: {e!r}", outcome="hook_failed")
+                    stop.wait(HOOK_POLL)
+            finally:
+                leader.release()
+
+
+def batch_key(job):
+    # Batchable jobs can share a claim with others running the same task,
+    # program or command.
+    if not job.get("batchable"):
+        return None
+    if job.get("task"):
+        return f"task:{job['task']}"
+    if job.get("args"):
+        return f"program:{job['args'][0]}"
+    return f"command:{job.get('command')}"
+
+
+class FileStore:
+    def __init__(self, config=None):
+        self.lock = lock
+        self.fsync = bool((config or load_config()).get("journal_fsync"))
+
+    def _journal(self, records):
+        # Caller must hold the lock.
+        return journal_append(records, self.fsync)
+
+    @contextmanager
+    def locked(self, stats=None):
+        start = time.perf_counter()
+        with self.lock:
+            if stats is not None:
+                stats.record_lock_wait(time.perf_counter() - start)
+                mark_phase(stats, "lock", start)
+            yield
+
+    def _write(self, file_path, jobs, stats=None):
+        # Caller must hold the lock.
+        t = time.perf_counter()
+        existing = load_jobs(file_path)
+        t = mark_phase(stats, "load", t)
+        if file_path == QUEUE_FILE:
+            track_pending(existing, jobs)
+        elif file_path in (PROCESSED_FILE, FAILED_FILE):
+            record_outcomes(jobs, "succeeded" if file_path == PROCESSED_FILE else "dead")
+        existing.extend(jobs)
+        t = mark_phase(stats, "mutate", t)
+        written = save_jobs(file_path, existing)
+        mark_phase(stats, "save", t)
+        if stats is not None:
+            stats.bytes_written += written
+        return written
+
+    def _coalesce(self, jobs):
+        # Caller must hold the lock. Returns (jobs to append, jobs merged into
+        # a pending job with the same key); merging only touches the index.
+        if not any(job.get("coalesce_key") for job in jobs):
+            return jobs, []
+        index = load_coalesce()
+        fresh, merged = [], []
+        for job in jobs:
+            key = job.get("coalesce_key")
+            entry = index.get(key) if key else None
+            if key and entry is None:
+                index[key] = {"id": job.get("id"), "merged": 0}
+            if entry is None:
+                fresh.append(job)
+                continue
+            entry["merged"] += 1
+            job["state"] = "coalesced"
+            job["coalesced_into"] = entry["id"]
+            merged.append(job)
+        save_coalesce(index)
+        return fresh, merged
+
+    def _uncoalesce(self, job):
+        # Caller must hold the lock. Runs before queue.json is saved, so a
+        # crash in between can only cause a duplicate, never a lost merge.
+        index = load_coalesce()
+        entry = index.get(job["coalesce_key"])
+        if entry is None or entry["id"] != job.get("id"):
+            return
+        del index[job["coalesce_key"]]
+        save_coalesce(index)
+        if entry["merged"]:
+            job["coalesced"] = entry["merged"]
+
+    def enqueue(self, jobs, stats=None, quota=True):
+        # Jobs fired from the schedule were accepted earlier and skip quotas.
+        if not any(job.get("depends_on") for job in jobs):
+            with self.locked(stats):
+                if quota:
+                    check_tenant_quota(jobs)
+                fresh, merged = self._coalesce(jobs)
+                written = self._write(QUEUE_FILE, fresh, stats) if fresh else 0
+                self._journal([journal_record(job, "enqueued") for job in fresh]
+                              + [journal_record(job, "coalesced") for job in merged])
+            return written
+        with self.locked(stats):
+            if quota:
+                check_tenant_quota(jobs)
+            ready, failed = add_waiting_jobs(jobs)
+            written = self._write(QUEUE_FILE, ready, stats) if ready else 0
+            if failed:
+                written += self._write(FAILED_FILE, failed, stats)
+            # Jobs already waiting can be released or failed by this submission too.
+            submitted = {id(job) for job in jobs}
+            self._journal([journal_record(job, "enqueued") for job in jobs]
+                          + [journal_record(job, "ready") for job in ready if id(job) not in submitted]
+                          + [journal_record(job, "dead_lettered") for job in failed if id(job) not in submitted])
+        return written
+
+    def claim(self, stats=None, node=NODE_ID):
+        claimed = self.claim_batch(1, stats, node)
+        return claimed[0] if claimed else None
+
+    def claim_batch(self, limit=1, stats=None, node=NODE_ID):
+        # A batchable job at the head brings up to limit-1 more jobs with the
+        # same batch key, all taken in one write. Rate limits apply per job,
+        # so with limits configured a claim stays a single job. Once jobs have
+        # owners, the head is picked per owner by fair_claim instead. Claimed
+        # jobs are stamped with the claiming node.
+        start = time.perf_counter()
+        with self.locked(stats):
+            t = time.perf_counter()
+            jobs = load_jobs(QUEUE_FILE)
+            t = mark_phase(stats, "load", t)
+            if not jobs:
+                return []
+            rules = load_limits()
+            tenant_state = load_tenant_state()
+            if tenant_state is not None and not tenant_state["ring"]:
+                # The owner FIFOs were lost, e.g. queue.json was edited by hand;
+                # renumber the queue from scratch.
+                count_pending(tenant_state, jobs)
+                save_jobs(QUEUE_FILE, jobs)
+            if tenant_state is not None:
+                limit_state = load_limit_state() if rules else None
+                picked = fair_claim(jobs, tenant_state, load_tenants(), rules, limit_state, time.time(), limit)
+                claimed = [jobs[i] for i in picked]
+                hold_tenants(tenant_state, claimed, node)
+                save_tenant_state(tenant_state)
+                if rules:
+                    hold_limits(limit_state, rules, claimed, node)
+                    save_limit_state(limit_state)
+                if not picked:
+                    return []
+                picked = set(picked)
+                jobs = [job for i, job in enumerate(jobs) if i not in picked]
+            elif rules:
+                state = load_limit_state()
+                index = acquire_limited_job(jobs, rules, state, time.time())
+                claimed = [] if index is None else [jobs.pop(index)]
+                hold_limits(state, rules, claimed, node)
+                save_limit_state(state)
+                if not claimed:
+                    return []
+            else:
+                claimed = [jobs.pop(0)]
+                key = batch_key(claimed[0])
+                if key and limit > 1:
+                    remaining = []
+                    for job in jobs:
+                        if len(claimed) < limit and batch_key(job) == key:
+                            claimed.append(job)
+                        else:
+                            remaining.append(job)
+                    jobs = remaining
+            for job in claimed:
+                job["claimed_by"] = node
+                if job.get("coalesce_key"):
+                    self._uncoalesce(job)
+            t = mark_phase(stats, "mutate", t)
+            written = save_jobs(QUEUE_FILE, jobs)
+            self._journal([journal_record(job, "claimed", "running") for job in claimed])
+            mark_phase(stats, "save", t)
+        if stats is not None:
+            stats.bytes_written += written
+            for _ in claimed:
+                stats.record_claim(time.perf_counter() - start)
+        return claimed
+
+    def cache_lookup(self, fingerprint):
+        # Returns a fresh cached result or None, counting the hit or miss.
+        now = time.time()
+        path = cache_path(fingerprint)
+        try:
+            with open(path, "r") as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            entry = None
+        try:
+            if entry is not None and entry["expires"] <= now:
+                os.remove(path)
+                entry = None
+            elif entry is not None:
+                os.utime(path)
+        except FileNotFoundError:
+            pass
+        count_cache("misses" if entry is None else "hits")
+        return entry
+
+    def _cache_results(self, jobs):
+        # Runs outside the queue lock; entries are written atomically.
+        jobs = [job for job in jobs if job.get("fingerprint") and not job.get("cached")]
+        if not jobs:
+            return
+        now = time.time()
+        for job in jobs:
+            write_cache_entry(job["fingerprint"], {
+                "job_id": job.get("id"), "output": job.get("output"), "duration": job.get("duration"),
+                "expires": now + job["cache_ttl"]})
+        evict_cache(now)
+
+    def complete(self, job, stats=None):
+        job["state"] = "processed"
+        self._cache_results([job])
+        with self.locked(stats):
+            release_claims([job])
+            released, _ = resolve_dependents(job.get("id"), True)
+            self._write(PROCESSED_FILE, [job], stats)
+            if released:
+                self._write(QUEUE_FILE, released, stats)
+            self._journal([journal_record(job, "succeeded")] + [journal_record(j, "ready") for j in released])
+        if stats is not None:
+            stats.succeeded += 1
+            stats.record_finish(job.get("id"))
+
+    def counts(self):
+        pending = load_jobs(QUEUE_FILE)
+        return {
+            "pending": len(pending),
+            "failed": len(load_jobs(FAILED_FILE)),
+            "oldest": pending[0].get("created_at") if pending else None,
+        }
+
+    def put_blob(self, data):
+        return store_blob(data)
+
+    def heartbeat(self, lease):
+        now = time.time()
+        with self.locked():
+            leases = load_leases()
+            leases = {node: l for node, l in leases.items() if l["expires"] > now - LEASE_TTL * 10}
+            if lease["expires"] > now:
+                leases[lease["node"]] = lease
+            else:
+                leases.pop(lease["node"], None)
+            with open(LEASE_FILE, "w") as f:
+                json.dump(leases, f, indent=2)
+            reclaim_claims({node for node, l in leases.items() if l["expires"] > now})
+
+    def release(self, jobs):
+        # Puts claimed-but-unfinished jobs back on the queue, e.g. on shutdown.
+        with self.locked():
+            release_claims(jobs)
+            self._write(QUEUE_FILE, jobs)
+            self._journal([journal_record(job, "released", "pending") for job in jobs])
+
+    def requeue(self, job, stats=None):
+        with self.locked(stats):
+            release_claims([job])
+            self._write(QUEUE_FILE, [job], stats)
+            self._journal([journal_record(job, "failed", "running"), journal_record(job, "retried", "pending")])
+        if stats is not None:
+            stats.failed += 1
+            stats.retried += 1
+
+    def dead_letter(self, job, stats=None):
+        job["state"] = "failed"
+        with self.locked(stats):
+            release_claims([job])
+            released, cascaded = resolve_dependents(job.get("id"), False)
+            self._write(FAILED_FILE, [job] + cascaded, stats)
+            if released:
+                self._write(QUEUE_FILE, released, stats)
+            self._journal([journal_record(job, "failed", "running")]
+                          + [journal_record(j, "dead_lettered") for j in [job] + cascaded]
+                          + [journal_record(j, "ready") for j in released])
+        if stats is not None:
+            stats.failed += 1
+            stats.dead_lettered += 1
+            stats.record_finish(job.get("id"))
+
+    def reject(self, job, error):
+        # For jobs that never ran, e.g. a delayed job whose parents are gone.
+        job["state"] = "failed"
+        job["error"] = error
+        with self.locked():
+            released, cascaded = resolve_dependents(job.get("id"), False)
+            self._write(FAILED_FILE, [job] + cascaded)
+            if released:
+                self._write(QUEUE_FILE, released)
+            self._journal([journal_record(j, "dead_lettered") for j in [job] + cascaded]
+                          + [journal_record(j, "ready") for j in released])
+
+    def finish_batch(self, succeeded, retried, dead, stats=None):
+        # Acks a whole batch under one lock, with one write per file. Retries
+        # go to the schedule with their backoff instead of blocking the worker.
+        for job in succeeded:
+            job["state"] = "processed"
+        for job in dead:
+            job["state"] = "failed"
+        retried_jobs = [job for job, _ in retried]
+        self._cache_results(succeeded)
+        with self.locked(stats):
+            release_claims(succeeded + retried_jobs + dead)
+            released, cascaded = [], []
+            for job in succeeded:
+                released.extend(resolve_dependents(job.get("id"), True)[0])
+            for job in dead:
+                ready, failed = resolve_dependents(job.get("id"), False)
+                released.extend(ready)
+                cascaded.extend(failed)
+            if succeeded:
+                self._write(PROCESSED_FILE, succeeded, stats)
+            if dead or cascaded:
+                self._write(FAILED_FILE, dead + cascaded, stats)
+            if released:
+                self._write(QUEUE_FILE, released, stats)
+            if retried:
+                self._write(SCHEDULE_FILE, [{"id": f"retry:{job.get('id')}", "run_at": run_at, "cron": None, "job": job}
+                                            for job, run_at in retried], stats)
+            self._journal([journal_record(job, "succeeded") for job in succeeded]
+                          + [journal_record(job, "failed", "running") for job in retried_jobs + dead]
+                          + [journal_record(job, "retried", "scheduled") for job in retried_jobs]
+                          + [journal_record(job, "dead_lettered") for job in dead + cascaded]
+                          + [journal_record(job, "ready") for job in released])
+        if stats is not None:
+            stats.succeeded += len(succeeded)
+            stats.failed += len(retried) + len(dead)
+            stats.retried += len(retried)
+            stats.dead_lettered += len(dead)
+            for job in succeeded + dead:
+                stats.record_finish(job.get("id"))
+
+
+def load_leases():
+    if not os.path.exists(LEASE_FILE):
+        return {}
+    with open(LEASE_FILE, "r") as f:
+        try:
+            return json.load(f)
+        except json.JSONDecodeError:
+            return {}
+
+
+class QueueServerError(Exception):
+    pass
+
+
+class RemoteStore:
+    # Same interface as FileStore, backed by a `queuectl server` over TCP.
+    # Each worker thread keeps its own connection; requests and responses
+    # are single JSON lines.
+    def __init__(self, address):
+        host, _, port = address.rpartition(":")
+        self.address = (host or "127.0.0.1", int(port))
+        self.token = os.environ.get(TOKEN_ENV)
+        self.local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            sock = socket.create_connection(self.address, timeout=60)
+            conn = self.local.conn = (sock, sock.makefile("rb"))
+        return conn
+
+    def _close(self):
+        conn = getattr(self.local, "conn", None)
+        self.local.conn = None
+        if conn is not None:
+            conn[1].close()
+            conn[0].close()
+
+    def call(self, op, attempts=3, **payload):
+        # Every attempt carries the same request id, so when only the reply
+        # was lost the server answers a retry from its reply cache instead of
+        # claiming or acking a second time.
+        payload["rid"] = f"{NODE_ID}:{os.urandom(8).hex()}"
+        if self.token:
+            payload["token"] = self.token
+        request = (json.dumps({"op": op, **payload}) + "\n").encode()
+        for attempt in range(attempts):
+            try:
+                sock, reader = self._connection()
+                sock.sendall(request)
+                line = reader.readline()
+                if not line:
+                    raise ConnectionError("queue server closed the connection")
+                break
+            except OSError:
+                self._close()
+                if attempt == attempts - 1:
+                    raise
+                time.sleep(min(2 ** attempt, 5))
+        response = json.loads(line)
+        if not response.get("ok"):
+            if response.get("type") == "QuotaExceeded":
+                raise QuotaExceeded(response.get("error"))
+            if response.get("type") == "ValueError":
+                raise ValueError(response.get("error"))
+            raise QueueServerError(response.get("error"))
+        return response
+
+    def _ack(self, op, job, stats):
+        try:
+            response = self.call(op, attempts=10, job=job)
+        except (OSError, QueueServerError) as e:
+            log_event(logging.ERROR, f"Could not {op} job {job.get('id')}: {e}",
+                      job_id=job.get("id"), outcome="ack_failed")
+            return
+        if stats is not None:
+            stats.merge(response["stats"])
+        return response
+
+    def enqueue(self, jobs, stats=None):
+        response = self.call("enqueue", jobs=jobs)
+        for job, stored in zip(jobs, response["jobs"]):
+            job.update(stored)
+        if stats is not None:
+            stats.merge(response["stats"])
+        return response["stats"]["bytes_written"]
+
+    def claim(self, stats=None):
+        claimed = self.claim_batch(1, stats)
+        return claimed[0] if claimed else None
+
+    def claim_batch(self, limit=1, stats=None):
+        start = time.perf_counter()
+        try:
+            response = self.call("claim_batch", limit=limit, node=NODE_ID)
+        except (OSError, QueueServerError) as e:
+            log_event(logging.WARNING, f"Queue server unavailable: {e}", outcome="server_unavailable")
+            return []
+        if stats is not None:
+            stats.merge({**response["stats"], "claimed": 0})
+            for _ in response["jobs"]:
+                stats.record_claim(time.perf_counter() - start)
+        return response["jobs"]
+
+    def complete(self, job, stats=None):
+        job["state"] = "processed"
+        if self._ack("complete", job, stats) and stats is not None:
+            stats.record_finish(job.get("id"))
+
+    def requeue(self, job, stats=None):
+        self._ack("requeue", job, stats)
+
+    def dead_letter(self, job, stats=None):
+        job["state"] = "failed"
+        if self._ack("dead_letter", job, stats) and stats is not None:
+            stats.record_finish(job.get("id"))
+
+    def finish_batch(self, succeeded, retried, dead, stats=None):
+        for job in succeeded:
+            job["state"] = "processed"
+        for job in dead:
+            job["state"] = "failed"
+        try:
+            response = self.call("finish_batch", attempts=10, succeeded=succeeded, retried=retried, dead=dead)
+        except (OSError, QueueServerError) as e:
+            log_event(logging.ERROR, f"Could not ack batch of {len(succeeded) + len(retried) + len(dead)} job(s): {e}",
+                      outcome="ack_failed")
+            return
+        if stats is not None:
+            stats.merge(response["stats"])
+            for job in succeeded + dead:
+                stats.record_finish(job.get("id"))
+
+    def release(self, jobs):
+        try:
+            self.call("release", attempts=10, jobs=jobs)
+        except (OSError, QueueServerError) as e:
+            log_event(logging.ERROR, f"Could not release {len(jobs)} job(s): {e}",
+                      outcome="release_failed", jobs=[job.get("id") for job in jobs])
+
+    def counts(self):
+        # None when the server is unreachable; callers skip that sample.
+        try:
+            return self.call("counts")["counts"]
+        except (OSError, QueueServerError) as e:
+            log_event(logging.WARNING, f"Queue server unavailable: {e}", outcome="server_unavailable")
+            return None
+
+    def cache_lookup(self, fingerprint):
+        try:
+            return self.call("cache_lookup", fingerprint=fingerprint)["entry"]
+        except (OSError, QueueServerError):
+            return None
+
+    def put_blob(self, data):
+        # A job whose output could not be stored is still acked, without it.
+        try:
+            return self.call("put_blob", attempts=10, data=base64.b64encode(data).decode())["ref"]
+        except (OSError, QueueServerError) as e:
+            log_event(logging.ERROR, f"Could not store job output: {e}", outcome="output_lost")
+            return None
+
+    def heartbeat(self, lease):
+        try:
+            self.call("heartbeat", lease=lease)
+        except (OSError, QueueServerError) as e:
+            log_event(logging.WARNING, f"Could not renew lease: {e}", outcome="lease_failed")
+
+
+class QueueRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                token = self.server.token
+                if token and not hmac.compare_digest(str(request.get("token", "")).encode(), token.encode()):
+                    self.wfile.write(b'{"ok": false, "type": "PermissionError", "error": "invalid or missing token"}\n')
+                    return
+                if request.get("rid"):
+                    response = self.server.once(request["rid"], lambda: self.respond(request))
+                else:
+                    response = self.respond(request)
+            except (ValueError, AttributeError) as e:
+                response = {"ok": False, "type": type(e).__name__, "error": str(e)}
+            self.wfile.write((json.dumps(response) + "\n").encode())
+
+    def respond(self, request):
+        try:
+            return {"ok": True, **self.dispatch(request)}
+        except (ValueError, KeyError, TypeError, OSError) as e:
+            return {"ok": False, "type": type(e).__name__, "error": str(e)}
+
+    def dispatch(self, request):
+        store = self.server.store
+        stats = WorkerStats(0, samples=True)
+        op = request["op"]
+        if op == "claim":
+            return {"job": store.claim(stats, request.get("node", NODE_ID)), "stats": stats.delta()}
+        if op == "claim_batch":
+            return {"jobs": store.claim_batch(request["limit"], stats, request.get("node", NODE_ID)),
+                    "stats": stats.delta()}
+        if op == "finish_batch":
+            store.finish_batch(request["succeeded"], request["retried"], request["dead"], stats)
+            return {"stats": stats.delta()}
+        if op in ("complete", "requeue", "dead_letter"):
+            getattr(store, op)(request["job"], stats)
+            return {"stats": stats.delta()}
+        if op == "enqueue":
+            jobs = request["jobs"]
+            store.enqueue(jobs, stats)
+            return {"jobs": jobs, "stats": stats.delta()}
+        if op == "release":
+            store.release(request["jobs"])
+            return {}
+        if op == "counts":
+            return {"counts": store.counts()}
+        if op == "cache_lookup":
+            return {"entry": store.cache_lookup(request["fingerprint"])}
+        if op == "put_blob":
+            return {"ref": store.put_blob(base64.b64decode(request["data"]))}
+        if op == "heartbeat":
+            store.heartbeat(request["lease"])
+            return {}
+        raise ValueError(f"unknown op: {op}")
+
+
+class QueueServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, token=None):
+        super().__init__(address, QueueRequestHandler)
+        self.store = FileStore()
+        self.token = token
+        self.replies = {}
+        self.reply_order = deque()
+        self.replies_lock = threading.Lock()
+
+    def once(self, rid, respond):
+        # A retry that arrives while the original is still running waits for
+        # its reply rather than running again.
+        with self.replies_lock:
+            entry = self.replies.get(rid)
+            first = entry is None
+            if first:
+                entry = self.replies[rid] = [threading.Event(), None]
+                self.reply_order.append(rid)
+                if len(self.reply_order) > REPLY_CACHE_SIZE:
+                    self.replies.pop(self.reply_order.popleft(), None)
+        if first:
+            try:
+                entry[1] = respond()
+            finally:
+                entry[0].set()
+        else:
+            entry[0].wait()
+        return entry[1]
+
+
+STORAGE_BACKENDS = {
+    "file": FileStore,
+    "server": RemoteStore,
+}
+
+def make_store(backend, server=None):
+    if backend == "server":
+        return RemoteStore(server)
+    return STORAGE_BACKENDS[backend]()
+
+def parse_cron_field(field, low, high):
+    values = set()
+    for part in field.split(","):
+        step = 1
+        if "/" in part:
+            part, step = part.split("/", 1)
+            step = int(step)
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start, end = (int(v) for v in part.split("-", 1))
+        else:
+            start = int(part)
+            end = high if step > 1 else start
+        if start < low or end > high or start > end or step < 1:
+            raise ValueError(f"cron field out of range: {field}")
+        values.update(range(start, end + 1, step))
+    return values
+
+def parse_cron(expr):
+    fields = expr.split()
+    if len(fields) != 5:
+        raise ValueError(f"cron expression needs 5 fields, got {len(fields)}")
+    minutes, hours, days, months, weekdays = (
+        parse_cron_field(field, low, high) for field, (low, high) in zip(fields, CRON_FIELDS))
+    if 7 in weekdays:
+        weekdays = (weekdays - {7}) | {0}
+    # As in cron(8): when both day fields are restricted, either may match.
+    either_day = not fields[2].startswith("*") and not fields[4].startswith("*")
+    return minutes, hours, days, months, weekdays, either_day
+
+def cron_next(expr, after):
+    minutes, hours, days, months, weekdays, either_day = parse_cron(expr)
+    t = datetime.fromtimestamp(after).replace(second=0, microsecond=0) + timedelta(minutes=1)
+    limit = t + timedelta(days=366 * 5)
+    while t < limit:
+        if t.month not in months:
+            t = (t.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            continue
+        day_ok = t.day in days
+        weekday_ok = t.isoweekday() % 7 in weekdays
+        if not ((day_ok or weekday_ok) if either_day else (day_ok and weekday_ok)):
+            t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            continue
+        if t.hour not in hours:
+            t = t.replace(minute=0) + timedelta(hours=1)
+            continue
+        if t.minute not in minutes:
+            t += timedelta(minutes=1)
+            continue
+        return t.timestamp()
+    raise ValueError(f"cron expression never fires: {expr}")
+
+
+class Scheduler:
+    # Due times are kept in a min-heap, so an idle tick is a stat() and a peek.
+    # The heap is rebuilt only when scheduled.json changes on disk.
+    def __init__(self, store):
+        self.store = store
+        self.heap = []
+        self.mtime = None
+
+    def refresh(self):
+        try:
+            mtime = os.stat(SCHEDULE_FILE).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self.mtime:
+            return
+        self.mtime = mtime
+        self.heap = [(entry["run_at"], entry["id"]) for entry in load_jobs(SCHEDULE_FILE)]
+        heapq.heapify(self.heap)
+
+    def tick(self, now=None):
+        now = now or time.time()
+        self.refresh()
+        if not self.heap or self.heap[0][0] > now:
+            return 0
+
+        due = set()
+        while self.heap and self.heap[0][0] <= now:
+            due.add(heapq.heappop(self.heap)[1])
+
+        fired = []
+        with lock:
+            remaining = []
+            for entry in load_jobs(SCHEDULE_FILE):
+                # Another supervisor may already have fired this entry.
+                if entry["id"] not in due or entry["run_at"] > now:
+                    remaining.append(entry)
+                    continue
+                if entry.get("cron"):
+                    run_at = entry["run_at"]
+                    entry["run_at"] = cron_next(entry["cron"], now)
+                    remaining.append(entry)
+                    try:
+                        job = build_job({**entry["job"], "id": f"{entry['id']}-{int(run_at)}"})
+                    except ValueError as e:
+                        log_event(logging.ERROR, f"Schedule '{entry['id']}' skipped a run: {e}",
+                                  outcome="schedule_failed")
+                        continue
+                else:
+                    job = entry["job"]
+                fired.append(job)
+            save_jobs(SCHEDULE_FILE, remaining)
+            if fired:
+                self.enqueue(fired)
+        self.mtime = os.stat(SCHEDULE_FILE).st_mtime_ns
+        self.heap = [(entry["run_at"], entry["id"]) for entry in remaining]
+        heapq.heapify(self.heap)
+        return len(fired)
+
+    def enqueue(self, jobs):
+        # Runs under the lock that removed these jobs from the schedule, so a
+        # job that cannot be enqueued lands in the DLQ instead of vanishing.
+        try:
+            self.store.enqueue(jobs, quota=False)
+            return
+        except (ValueError, KeyError, TypeError):
+            pass
+        for job in jobs:
+            try:
+                self.store.enqueue([job], quota=False)
+            except (ValueError, KeyError, TypeError) as e:
+                self.store.reject(job, f"could not enqueue scheduled job: {e}")
+                log_event(logging.ERROR, f"Scheduled job {job.get('id')} moved to DLQ: {e}",
+                          job_id=job.get("id"), outcome="dead_lettered")
+
+def schedule_entry(entry):
+    # Entries are never replaced; remove one first to change it.
+    with lock:
+        entries = load_jobs(SCHEDULE_FILE)
+        if any(e["id"] == entry["id"] for e in entries):
+            raise ValueError(f"schedule '{entry['id']}' already exists")
+        entries.append(entry)
+        save_jobs(SCHEDULE_FILE, entries)
+
+def schedule_job(job, run_at):
+    # One-off entries live under "once:" so they cannot collide with cron
+    # schedules or with each other.
+    with lock:
+        if job.get("depends_on"):
+            check_workflow([job])
+            check_parents([job])
+        check_tenant_quota([job])
+        entry_id = f"once:{job['id'] or os.urandom(8).hex()}"
+        schedule_entry({"id": entry_id, "run_at": run_at, "cron": None, "job": job})
+    return entry_id
+
+def blob_path(digest):
+    return os.path.join(BLOB_DIR, digest[:2], digest[2:])
+
+def store_blob(data):
+    # Content-addressed and write-once, so identical outputs share one file
+    # and nothing here needs the queue lock.
+    digest = hashlib.sha256(data).hexdigest()
+    path = blob_path(digest)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    return {"sha256": digest, "size": len(data)}
+
+def load_blob(ref):
+    with open(blob_path(ref["sha256"]), "rb") as f:
+        data = f.read()
+    if hashlib.sha256(data).hexdigest() != ref["sha256"]:
+        raise ValueError(f"checksum mismatch for blob {ref['sha256']}")
+    return data
+
+# Task modules do `from queuectl import task`; make that resolve to this
+# running script rather than importing a second copy with its own registry.
+sys.modules.setdefault("queuectl", sys.modules[__name__])
+TASKS = {}
+task_pool = None
+
+def task(name=None, batch=False):
+    # batch=True tasks take a list of kwargs dicts and return one result per item.
+    def register(func):
+        func.batch = batch
+        TASKS[name or f"{func.__module__}:{func.__qualname__}"] = func
+        return func
+    return register
+
+def load_task_modules(modules):
+    # Imported once per worker process and kept warm for every later job.
+    if os.getcwd() not in sys.path:
+        sys.path.insert(0, os.getcwd())
+    for module in filter(None, (m.strip() for m in modules.split(","))):
+        importlib.import_module(module)
+
+def resolve_task(name):
+    if name not in TASKS:
+        module, _, attr = name.partition(":")
+        if not attr:
+            raise LookupError(f"unknown task: {name}")
+        func = importlib.import_module(module)
+        for part in attr.split("."):
+            func = getattr(func, part)
+        TASKS[name] = func
+    return TASKS[name]
+
+def run_task(name, kwargs):
+    try:
+        result = resolve_task(name)(**kwargs)
+    except Exception:
+        return 1, traceback.format_exc().encode()
+    return 0, None if result is None else json.dumps(result, default=str).encode()
+
+def run_task_batch(name, items):
+    try:
+        func = resolve_task(name)
+        if not getattr(func, "batch", False):
+            return [run_task(name, kwargs) for kwargs in items]
+        results = func(items)
+        if len(results) != len(items):
+            raise ValueError(f"batch task returned {len(results)} result(s) for {len(items)} job(s)")
+    except Exception:
+        return [(1, traceback.format_exc().encode())] * len(items)
+    return [(0, None if result is None else json.dumps(result, default=str).encode()) for result in results]
+
+def job_exec_task(job, config):
+    # Runs in the worker thread, or in the task process pool when one is up.
+    if task_pool is None:
+        return run_task(job["task"], job.get("kwargs") or {})
+    timeout = job_timeout(job, config)
+    future = task_pool.submit(run_task, job["task"], job.get("kwargs") or {})
+    try:
+        return future.result(timeout=timeout)
+    except concurrent.futures.TimeoutError:
+        # A pool process cannot be killed on its own; it finishes in the background.
+        raise JobTimeout(timeout, None)
+    except concurrent.futures.process.BrokenProcessPool as e:
+        return 1, f"task process died: {e}\n".encode()
+
+def execute_batch(jobs, config, executor=None, stats=None, retire=None):
+    # Task jobs go to the task in one call; anything else runs job by job,
+    # still sharing the batch's single claim and ack. Once the worker is told
+    # to stop, jobs not yet started are left out of the results.
+    if executor is None and jobs[0].get("task"):
+        items = [job.get("kwargs") or {} for job in jobs]
+        if task_pool is None:
+            return run_task_batch(jobs[0]["task"], items)
         try:
-            return json.load(f)
-        except json.JSONDecodeError:
-            return []
+            return task_pool.submit(run_task_batch, jobs[0]["task"], items).result()
+        except concurrent.futures.process.BrokenProcessPool as e:
+            return [(1, f"task process died: {e}\n".encode())] * len(jobs)
+    results = []
+    for job in jobs:
+        if stats is not None and stats.abandoned:
+            break
+        if results and (stop_event.is_set() or retire is not None and retire.is_set()):
+            break
+        try:
+            results.append((executor or job_executor(job, config))(job, config))
+        except JobTimeout as e:
+            job["timed_out"] = True
+            results.append((TIMEOUT_EXIT_CODE, e.output))
+    return results
 
-def save_jobs(file_path,jobs):
-    with open(file_path, "w") as f:
-        json.dump(jobs, f, indent=2)
+def job_executor(job, config):
+    if job.get("task"):
+        return job_exec_task
+    name = config.get("executor", "simulation")
+    if name == "command" and uses_prefork(job, config):
+        return job_exec_prefork
+    return EXECUTORS[name]
 
-def job_exec_simulation(job):
-    success=random.random()>0.2
-    time.sleep(1)
-    return success
+# Executors take (job, config) and return (exit_code, captured output or None).
+def job_exec_simulation(job, config):
+    failure_rate = config.get("failure_rate", 0.3)
+    return (0 if random.random() > failure_rate else 1), None
 
-def worker_thread(worker_id, config):
-    print(f"Worker-{worker_id} started.")
-    while not stop_event.is_set():
-        if os.path.exists(STOP_FILE):
-            break
+def job_exec_noop(job, config):
+    return 0, None
 
-        with lock:
-            jobs = load_jobs(QUEUE_FILE)
-            if jobs:
-                job = jobs.pop(0)
-                save_jobs(QUEUE_FILE, jobs)
-            else:
-                job = None  
+class JobTimeout(Exception):
+    def __init__(self, timeout, output):
+        super().__init__(f"timed out after {timeout}s")
+        self.output = output
 
-        if job is None:
-            time.sleep(1)
-            continue
+def job_timeout(job, config):
+    return job.get("timeout") or config.get("job_timeout") or None
+
+def kill_process_group(proc, grace):
+    # The command runs in its own session, so signalling the group also
+    # reaches anything the shell spawned.
+    if os.name == "posix":
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    else:
+        proc.terminate()
+    try:
+        return proc.communicate(timeout=grace)[0]
+    except subprocess.TimeoutExpired:
+        pass
+    if os.name == "posix":
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    else:
+        proc.kill()
+    return proc.communicate()[0]
+
+# Thread id -> the process group a worker is waiting on, so a drain timeout can stop it.
+worker_processes = {}
+
+def stop_process_group(proc, grace):
+    # Signals only: the owning worker thread is still reading the output.
+    if os.name != "posix":
+        proc.kill()
+        return
+    for signum in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(proc.pid, signum)
+        except ProcessLookupError:
+            return
+        deadline = time.monotonic() + grace
+        while signum == signal.SIGTERM and proc.poll() is None and time.monotonic() < deadline:
+            time.sleep(0.05)
 
-        job_id = job.get("id")
-        retry_count = job.get("retries", 0)
+def job_exec_command(job, config):
+    # Jobs with `args` are exec'd directly, skipping the shell and its quoting.
+    timeout = job_timeout(job, config)
+    env = {**os.environ, **job["env"]} if job.get("env") else None
+    stdin = job.get("stdin")
+    try:
+        proc = subprocess.Popen(job["args"] if job.get("args") else job.get("command") or "",
+                                shell=not job.get("args"), start_new_session=True, env=env, cwd=job.get("cwd"),
+                                stdin=subprocess.PIPE if stdin is not None else subprocess.DEVNULL,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except OSError as e:
+        # Missing program or cwd; report it like a shell would.
+        return 127, f"{e}\n".encode()
+    worker_processes[threading.get_ident()] = proc
+    try:
+        output = proc.communicate(None if stdin is None else stdin.encode(), timeout=timeout)[0]
+    except subprocess.TimeoutExpired:
+        raise JobTimeout(timeout, kill_process_group(proc, config.get("kill_grace", 5)))
+    finally:
+        worker_processes.pop(threading.get_ident(), None)
+    return proc.returncode, output
+
+class ShellHelper:
+    # A long-lived /bin/sh owned by one worker thread. Each job runs in a
+    # subshell forked from it, so there is no Popen and no shell exec per job.
+    # The command is passed as a quoted string to eval, so a syntax error
+    # fails the job instead of wedging the helper.
+    def __init__(self):
+        self.proc = subprocess.Popen(["/bin/sh"], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT, start_new_session=True)
+        self.timed_out = False
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def kill(self, grace):
+        # Runs on a timer thread. The whole group gets SIGKILL after the grace
+        # period, since the job may ignore SIGTERM even once the helper is gone.
+        self.timed_out = True
+        for signum, wait in ((signal.SIGTERM, grace), (signal.SIGKILL, 0)):
+            try:
+                os.killpg(self.proc.pid, signum)
+            except ProcessLookupError:
+                return
+            time.sleep(wait)
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+        self.proc.stdout.close()
+
+    def run(self, command, timeout=None, grace=5):
+        marker = f"__queuectl_done_{os.urandom(8).hex()}__".encode()
+        self.proc.stdin.write(f"( eval {shlex.quote(command)} ) </dev/null 2>&1; "
+                              f"printf '\\n%s %d\\n' {marker.decode()} $?\n".encode())
+        self.proc.stdin.flush()
+        timer = threading.Timer(timeout, self.kill, args=(grace,)) if timeout else None
+        if timer:
+            timer.start()
+        chunks = []
+        try:
+            while True:
+                line = self.proc.stdout.readline()
+                if not line and self.timed_out:
+                    raise JobTimeout(timeout, b"".join(chunks))
+                if not line:
+                    return 1, b"".join(chunks) + b"executor helper exited unexpectedly\n"
+                if line.startswith(marker):
+                    break
+                chunks.append(line)
+        finally:
+            if timer:
+                timer.cancel()
+        # Drop the newline printed ahead of the marker.
+        return int(line.split()[1]), b"".join(chunks)[:-1]
+
+shell_helpers = threading.local()
+
+def uses_prefork(job, config):
+    queues = {q.strip() for q in config.get("prefork_queues", "").split(",") if q.strip()}
+    if os.name != "posix" or not queues or not ("*" in queues or job.get("queue") in queues):
+        return False
+    return not any(job.get(key) is not None for key in ("args", "env", "cwd", "stdin"))
+
+def close_shell_helper():
+    helper = getattr(shell_helpers, "helper", None)
+    if helper is not None:
+        shell_helpers.helper = None
+        helper.close()
+
+def job_exec_prefork(job, config):
+    # Pool size follows the worker count: one helper per worker thread.
+    helper = getattr(shell_helpers, "helper", None)
+    if helper is None or not helper.alive():
+        helper = shell_helpers.helper = ShellHelper()
+    worker_processes[threading.get_ident()] = helper.proc
+    try:
+        return helper.run(job.get("command") or ":", job_timeout(job, config), config.get("kill_grace", 5))
+    finally:
+        worker_processes.pop(threading.get_ident(), None)
+        if not helper.alive():
+            shell_helpers.helper = None
+            helper.close()
+
+EXECUTORS = {
+    "simulation": job_exec_simulation,
+    "command": job_exec_command,
+}
+
+def retry_policy(job, config):
+    policy = {
+        "strategy": "exponential",
+        "base": config.get("backoff_base", 2),
+        "max_delay": config.get("backoff_max", 300),
+        "jitter": config.get("backoff_jitter", "none"),
+        "retry_on": None,
+    }
+    policy.update(job.get("retry") or {})
+    return policy
 
+def should_retry(job, config, exit_code):
+    max_retries = job.get("max_retries")
+    if max_retries is None:
         max_retries = config.get("max_retries", 3)
-        backoff_base = config.get("backoff_base", 2)
-        failure_rate = config.get("failure_rate", 0.3)
+    if job.get("retries", 0) >= max_retries:
+        return False
+    retry_on = retry_policy(job, config)["retry_on"]
+    if job.get("timed_out") and retry_on and "timeout" in retry_on:
+        return True
+    return not retry_on or exit_code in retry_on
 
-        print(f"Worker-{worker_id} executing: {job.get('command')} (attempt {retry_count + 1})")
-        success = random.random() > failure_rate
+def retry_delay(job, config):
+    policy = retry_policy(job, config)
+    retries = job.get("retries", 1)
+    base = policy["base"]
+    cap = policy["max_delay"]
+    if policy["strategy"] == "fixed":
+        delay = base
+    elif policy["strategy"] == "linear":
+        delay = base * retries
+    else:
+        try:
+            delay = base ** retries
+        except OverflowError:
+            delay = math.inf
+    delay = min(cap, delay) if cap else delay
 
-        if success:
-            print(f"Worker-{worker_id} finished: {job_id}")
-            processed = load_jobs(PROCESSED_FILE)
-            processed.append(job)
-            save_jobs(PROCESSED_FILE, processed)
-        else:
-            retry_count += 1
-            job["retries"] = retry_count
-            if retry_count < max_retries:
-                backoff = backoff_base ** retry_count
-                print(f"Job {job_id} failed. Retrying in {backoff}s ({retry_count}/{max_retries})")
-                time.sleep(backoff)
-                with lock:
-                    jobs = load_jobs(QUEUE_FILE)
-                    jobs.append(job)
-                    save_jobs(QUEUE_FILE, jobs)
+    if policy["jitter"] == "full":
+        delay = random.uniform(0, delay)
+    elif policy["jitter"] == "decorrelated":
+        previous = job.get("last_backoff") or base
+        delay = random.uniform(base, previous * 3)
+        delay = min(cap, delay) if cap else delay
+        job["last_backoff"] = delay
+    return delay
+
+def ack(stats, method, *args):
+    # Once the supervisor has taken a job back after a drain timeout, the
+    # worker's late result must not be recorded too.
+    with stats.ack_lock:
+        if stats.abandoned:
+            return False
+        method(*args, stats)
+        stats.current_job = None
+        stats.in_flight = []
+        return True
+
+def run_batch(worker_id, jobs, config, store, stats, executor=None, retire=None):
+    succeeded, pending = [], []
+    for job in jobs:
+        cached = store.cache_lookup(job["fingerprint"]) if job.get("fingerprint") else None
+        if cached is None:
+            job.pop("timed_out", None)
+            pending.append(job)
+            continue
+        job["cached"] = True
+        job["cached_from"] = cached["job_id"]
+        job["duration"] = 0
+        if cached.get("output"):
+            job["output"] = cached["output"]
+        succeeded.append(job)
+    retried, dead = [], []
+    if pending:
+        log_event(logging.INFO, f"Worker-{worker_id} executing batch of {len(pending)}: {batch_key(pending[0])}",
+                  worker_id=worker_id, outcome="started", batch_size=len(pending))
+        started = time.perf_counter()
+        results = execute_batch(pending, config, executor, stats, retire)
+        duration = (mark_phase(stats, "exec", started) - started) / max(1, len(results))
+        unstarted = pending[len(results):]
+        if unstarted:
+            # Stopping: hand the jobs that never started back to the queue.
+            with stats.ack_lock:
+                released = not stats.abandoned
+                if released:
+                    store.release(unstarted)
+                    returned = {id(job) for job in unstarted}
+                    stats.in_flight = [job for job in stats.in_flight if id(job) not in returned]
+            if released:
+                log_event(logging.INFO, f"Worker-{worker_id} stopping, requeued {len(unstarted)} unstarted job(s) of its batch.",
+                          worker_id=worker_id, outcome="requeued", jobs=[job.get("id") for job in unstarted])
+        retry_at = time.time()
+        for job, (exit_code, output) in zip(pending, results):
+            stats.exec_duration.observe(duration)
+            job["duration"] = round(duration, 6)
+            job["batch_size"] = len(pending)
+            if output:
+                job["output"] = store.put_blob(output)
+            if exit_code == 0:
+                succeeded.append(job)
+                continue
+            if job.get("timed_out"):
+                stats.timed_out += 1
+            job["retries"] = job.get("retries", 0) + 1
+            job["exit_code"] = exit_code
+            if should_retry(job, config, exit_code):
+                retried.append((job, retry_at + retry_delay(job, config)))
             else:
-                print(f"Job {job_id} moved to DLQ after {max_retries} failures.")
-                with lock:
-                    failed = load_jobs(FAILED_FILE)
-                    failed.append(job)
-                    save_jobs(FAILED_FILE, failed)
+                dead.append(job)
+    if not ack(stats, store.finish_batch, succeeded, retried, dead):
+        return
+    level = logging.INFO if not retried and not dead else logging.WARNING
+    log_event(level, f"Worker-{worker_id} finished batch of {len(succeeded) + len(retried) + len(dead)}: {len(succeeded)} succeeded, "
+              f"{len(retried)} retrying, {len(dead)} moved to DLQ",
+              worker_id=worker_id, outcome="batch_finished", batch_size=len(jobs))
+
+def run_job(worker_id, job, config, store, stats, executor=None):
+    run = executor or job_executor(job, config)
+    job_id = job.get("id")
+    cached = store.cache_lookup(job["fingerprint"]) if job.get("fingerprint") else None
+    if cached is not None:
+        job["cached"] = True
+        job["cached_from"] = cached["job_id"]
+        job["duration"] = 0
+        if cached.get("output"):
+            job["output"] = cached["output"]
+        if ack(stats, store.complete, job):
+            log_event(logging.INFO, f"Worker-{worker_id} finished: {job_id} (cached result of {cached['job_id']})",
+                      job_id=job_id, worker_id=worker_id, outcome="cache_hit")
+        return
+    attempt = job.get("retries", 0) + 1
+    log_event(logging.INFO, f"Worker-{worker_id} executing: {job.get('command')} (attempt {attempt})",
+              job_id=job_id, worker_id=worker_id, attempt=attempt, outcome="started")
+    started = time.perf_counter()
+    job.pop("timed_out", None)
+    try:
+        exit_code, output = run(job, config)
+    except JobTimeout as e:
+        exit_code, output = TIMEOUT_EXIT_CODE, e.output
+        job["timed_out"] = True
+        stats.timed_out += 1
+        log_event(logging.WARNING, f"Job {job_id} {e}.",
+                  job_id=job_id, worker_id=worker_id, attempt=attempt, outcome="timed_out")
+    duration = mark_phase(stats, "exec", started) - started
+    stats.exec_duration.observe(duration)
+    job["duration"] = round(duration, 6)
+    if output:
+        job["output"] = store.put_blob(output)
 
-    print(f"Worker-{worker_id} stopped gracefully.")
+    if stats.abandoned:
+        log_event(logging.WARNING, f"Worker-{worker_id} dropped the result of {job_id}; it was requeued at shutdown.",
+                  job_id=job_id, worker_id=worker_id, attempt=attempt, outcome="abandoned")
+    elif exit_code == 0:
+        ack(stats, store.complete, job)
+        log_event(logging.INFO, f"Worker-{worker_id} finished: {job_id}",
+                  job_id=job_id, worker_id=worker_id, attempt=attempt, duration=duration, outcome="succeeded")
+    else:
+        job["retries"] = attempt
+        job["exit_code"] = exit_code
+        if should_retry(job, config, exit_code):
+            backoff = retry_delay(job, config)
+            log_event(logging.WARNING, f"Job {job_id} failed with exit code {exit_code}. Retrying in {backoff:.1f}s (attempt {attempt})",
+                      job_id=job_id, worker_id=worker_id, attempt=attempt, duration=duration,
+                      outcome="retrying", exit_code=exit_code, backoff=backoff)
+            # The backoff is served from the schedule, like a batch's retries,
+            # so it holds neither this worker nor the job's limit slots.
+            ack(stats, store.finish_batch, [], [(job, time.time() + backoff)], [])
+        elif ack(stats, store.dead_letter, job):
+            log_event(logging.ERROR, f"Job {job_id} moved to DLQ after {attempt} attempt(s) (exit code {exit_code}).",
+                      job_id=job_id, worker_id=worker_id, attempt=attempt, duration=duration,
+                      outcome="dead_lettered", exit_code=exit_code)
 
-def start_workers(count: int):
-    config = load_config()
+def worker_thread(worker_id, settings, executor=None, store=None, stats=None, retire=None):
+    store = store or FileStore()
+    stats = stats or WorkerStats(worker_id)
+    retire = retire or threading.Event()
+    if stats.profiler is not None:
+        stats.profiler.enable()
+    stats.thread_id = threading.get_ident()
+    log_event(logging.INFO, f"Worker-{worker_id} started.", worker_id=worker_id, outcome="started")
+    # The hot loop only checks in-memory Events; the supervisor owns the stop
+    # flag and signals, and sets `retire` to wake idle waits and backoff.
+    while not retire.is_set() and not stop_event.is_set():
+        with stats.ack_lock:
+            if stats.abandoned:
+                break
+            jobs = store.claim_batch(settings.config["batch_max"], stats)
+            stats.last_seen = time.time()
+            stats.current_job = jobs[0] if jobs else None
+            stats.in_flight = jobs
+
+        if not jobs:
+            retire.wait(1)
+            continue
+        stats.job_started = stats.last_seen
+        try:
+            if len(jobs) > 1:
+                run_batch(worker_id, jobs, settings.config, store, stats, executor, retire)
+            else:
+                run_job(worker_id, jobs[0], settings.config, store, stats, executor)
+        except Exception as e:
+            # Put the claim back rather than let the thread die holding it,
+            # and with it the jobs' limit and tenant slots.
+            log_event(logging.ERROR, f"Worker-{worker_id} failed handling {len(jobs)} job(s): {e!r}",
+                      worker_id=worker_id, outcome="worker_error")
+            with stats.ack_lock:
+                if not stats.abandoned and stats.in_flight:
+                    store.release(stats.in_flight)
+                    stats.current_job = None
+                    stats.in_flight = []
+
+    if stats.profiler is not None:
+        stats.profiler.disable()
+    close_shell_helper()
+    log_event(logging.INFO, f"Worker-{worker_id} stopped gracefully.", worker_id=worker_id, outcome="stopped")
+
+def queue_depth(store, watcher=None):
+    # A file-backed supervisor follows the journal rather than re-reading
+    # queue.json and failed.json for every sample.
+    if watcher is not None:
+        watcher.poll()
+        return {"pending": watcher.counts["pending"], "failed": watcher.counts["failed"]}
+    counts = store.counts()
+    return {} if counts is None else {"pending": counts["pending"], "failed": counts["failed"]}
+
+def render_metrics(stats, depth):
+    lines = []
+
+    def header(name, kind, text):
+        lines.append(f"# HELP {name} {text}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    counters = (
+        ("queuectl_jobs_claimed_total", "claimed", "Jobs claimed from the queue."),
+        ("queuectl_jobs_succeeded_total", "succeeded", "Jobs that completed successfully."),
+        ("queuectl_jobs_failed_total", "failed", "Failed job attempts."),
+        ("queuectl_jobs_dead_lettered_total", "dead_lettered", "Jobs moved to the DLQ."),
+        ("queuectl_jobs_retried_total", "retried", "Jobs requeued for another attempt."),
+        ("queuectl_jobs_timed_out_total", "timed_out", "Job attempts killed for exceeding their timeout."),
+    )
+    for name, attr, text in counters:
+        header(name, "counter", text)
+        for s in stats:
+            lines.append(f'{name}{{worker="{s.worker_id}"}} {getattr(s, attr)}')
+
+    histograms = (
+        ("queuectl_job_exec_seconds", "exec_duration", "Job execution duration."),
+        ("queuectl_lock_wait_seconds", "lock_wait_duration", "Time spent waiting for the queue lock."),
+    )
+    for name, attr, text in histograms:
+        header(name, "histogram", text)
+        for s in stats:
+            hist = getattr(s, attr)
+            counts = list(hist.counts)
+            cumulative = 0
+            for bound, count in zip(hist.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{worker="{s.worker_id}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_sum{{worker="{s.worker_id}"}} {hist.sum}')
+            lines.append(f'{name}_count{{worker="{s.worker_id}"}} {cumulative}')
+
+    if depth:
+        header("queuectl_queue_depth", "gauge", "Jobs currently stored per state.")
+        lines.append(f'queuectl_queue_depth{{state="pending"}} {depth["pending"]}')
+        lines.append(f'queuectl_queue_depth{{state="failed"}} {depth["failed"]}')
+    return "\n".join(lines) + "\n"
+
+def write_metrics_file(path, stats, depth):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(render_metrics(stats, depth))
+    os.replace(tmp_path, path)
+
+def serve_metrics(port, stats, depth):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = render_metrics(stats, depth).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def print_profile_summary(stats):
+    durations = {phase: [] for phase in PROFILE_PHASES}
+    for s in stats:
+        for phase, _, duration in s.phases:
+            durations[phase].append(duration)
+    total = sum(sum(values) for values in durations.values()) or 1
+
+    print("\nProfile Summary")
+    print("-" * 60)
+    print(f"{'Phase':<8}{'Count':>8}{'Total ms':>12}{'Mean ms':>10}{'p95 ms':>10}{'Share':>10}")
+    for phase, values in durations.items():
+        spent = sum(values)
+        mean = spent / len(values) if values else 0
+        print(f"{phase:<8}{len(values):>8}{spent * 1000:>12.2f}{mean * 1000:>10.3f}"
+              f"{percentile(values, 95) * 1000:>10.3f}{spent / total:>10.1%}")
+    print("-" * 60)
+
+def write_profile_pstats(path, stats, profiler=None):
+    profilers = [profiler] if profiler is not None else [s.profiler for s in stats if s.profiler is not None]
+    if not profilers:
+        return
+    merged = pstats.Stats(profilers[0])
+    for profiler in profilers[1:]:
+        merged.add(profiler)
+    merged.dump_stats(path)
+    print(f"cProfile stats written to {path}")
+
+def write_profile_trace(path, stats):
+    pid = os.getpid()
+    events = []
+    for s in stats:
+        for phase, start, duration in s.phases:
+            events.append({
+                "name": phase,
+                "ph": "X",
+                "ts": start * 1e6,
+                "dur": duration * 1e6,
+                "pid": pid,
+                "tid": s.worker_id,
+            })
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events}, f)
+    print(f"Trace events written to {path}")
+
+class WorkerPool:
+    def __init__(self, settings, executor, store, stats, samples=False, profile=False, profile_pstats=None):
+        self.settings = settings
+        self.executor = executor
+        self.store = store
+        self.stats = stats
+        self.samples = samples
+        self.profile = profile
+        self.profile_pstats = profile_pstats
+        self.workers = []
+        self.retired = []
+        self.next_id = 1
+
+    def size(self):
+        return len(self.workers)
+
+    def resize(self, count):
+        while len(self.workers) < count:
+            worker_id = self.next_id
+            self.next_id += 1
+            worker_stats = WorkerStats(worker_id, samples=self.samples, profile=self.profile)
+            if self.profile and self.profile_pstats and not PROFILE_ALL_THREADS:
+                worker_stats.profiler = cProfile.Profile()
+            retire = threading.Event()
+            t = threading.Thread(target=worker_thread, daemon=True,
+                                 args=(worker_id, self.settings, self.executor, self.store, worker_stats, retire))
+            t.start()
+            self.workers.append((t, retire, worker_stats))
+            self.stats.append(worker_stats)
+        while len(self.workers) > count:
+            # Retired workers finish their current job before exiting.
+            worker = self.workers.pop()
+            worker[1].set()
+            self.retired.append(worker)
+
+    def registry(self):
+        # Retired workers stay listed until their last job is done.
+        return [s.snapshot() for t, _, s in self.workers + self.retired if t.is_alive()]
+
+    def stop(self):
+        for _, retire, _ in self.workers:
+            retire.set()
+
+    def join(self, timeout=None):
+        # Returns the stats of workers still busy when the timeout expired.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        busy = []
+        for t, _, worker_stats in self.workers + self.retired:
+            t.join(None if deadline is None else max(0, deadline - time.monotonic()))
+            if t.is_alive():
+                busy.append(worker_stats)
+        return busy
+
+class Autoscaler:
+    # Grows quickly when work backs up and shrinks one worker at a time once
+    # the backlog fits comfortably in a smaller pool (hysteresis), with
+    # separate cooldowns so the pool does not flap.
+    def __init__(self, pool, minimum, maximum):
+        self.pool = pool
+        self.minimum = minimum
+        self.maximum = maximum
+        self.last_check = 0
+        self.last_scale = 0
+        psutil.cpu_percent(interval=None)
+
+    def sample(self, now):
+        counts = self.pool.store.counts()
+        if counts is None:
+            return None
+        age = 0
+        if counts["oldest"]:
+            created = datetime.strptime(counts["oldest"], "%Y-%m-%dT%H:%M:%SZ")
+            age = now - created.replace(tzinfo=timezone.utc).timestamp()
+        cpu = psutil.cpu_percent(interval=None)
+        if hasattr(os, "getloadavg"):
+            cpu = max(cpu, 100 * os.getloadavg()[0] / (os.cpu_count() or 1))
+        return counts["pending"], age, cpu
+
+    def desired_size(self, config, depth, age, cpu):
+        size = self.pool.size()
+        per_worker = config["autoscale_jobs_per_worker"]
+        wanted = math.ceil(depth / per_worker)
+        if age > config["autoscale_max_age"]:
+            wanted = max(wanted, size + 1)
+        if wanted > size:
+            if cpu >= config["autoscale_max_cpu"]:
+                return size
+            return min(self.maximum, wanted)
+        if size > self.minimum and depth <= (size - 1) * per_worker / 2:
+            return size - 1
+        return size
+
+    def tick(self, config, now=None):
+        now = now or time.time()
+        if now - self.last_check < AUTOSCALE_INTERVAL:
+            return
+        self.last_check = now
+        size = self.pool.size()
+        sample = self.sample(now)
+        if sample is None:
+            return
+        depth, age, cpu = sample
+        desired = max(self.minimum, min(self.maximum, self.desired_size(config, depth, age, cpu)))
+        if desired == size:
+            return
+        cooldown = config["autoscale_up_cooldown"] if desired > size else config["autoscale_down_cooldown"]
+        if now - self.last_scale < cooldown:
+            return
+        log_event(logging.INFO, f"Autoscaling from {size} to {desired} worker(s) "
+                                f"(depth {depth}, oldest {age:.0f}s, cpu {cpu:.0f}%).",
+                  outcome="autoscaled", workers=desired, depth=depth, age=age, cpu=cpu)
+        self.pool.resize(desired)
+        self.last_scale = now
+
+class Watchdog:
+    # Reports jobs running far longer than the pool's usual execution time,
+    # once per job attempt. Only the supervisor thread touches it.
+    def __init__(self, pool):
+        self.pool = pool
+        self.reported = set()
 
-    if os.path.exists(STOP_FILE):
-        os.remove(STOP_FILE)
+    def threshold(self, config):
+        histograms = [s.exec_duration for s in self.pool.stats]
+        if not histograms:
+            return None
+        counts = [sum(c) for c in zip(*(h.counts for h in histograms))]
+        if sum(counts) < WATCHDOG_MIN_SAMPLES:
+            return None
+        bound = histograms[0].quantile(config["watchdog_percentile"] / 100, counts)
+        return None if bound is None else max(bound * config["watchdog_factor"], WATCHDOG_MIN_RUNTIME)
+
+    def tick(self, config, now=None):
+        threshold = self.threshold(config)
+        if threshold is None:
+            return
+        now = now or time.time()
+        running = set()
+        for record in self.pool.registry():
+            if not record["job"]:
+                continue
+            key = (record["worker"], record["job"], record["job_started"])
+            running.add(key)
+            elapsed = now - record["job_started"]
+            if elapsed > threshold and key not in self.reported:
+                self.reported.add(key)
+                log_event(logging.WARNING,
+                          f"Job {record['job']} on Worker-{record['worker']} has been running {elapsed:.0f}s "
+                          f"(p{config['watchdog_percentile']} x{config['watchdog_factor']} = {threshold:.1f}s).",
+                          job_id=record["job"], worker_id=record["worker"], outcome="stuck", running=elapsed)
+        self.reported &= running
+
+def read_scale_request():
+    if not os.path.exists(SCALE_FILE):
+        return None
+    try:
+        with open(SCALE_FILE, "r") as f:
+            count = int(f.read().strip())
+    except (OSError, ValueError):
+        count = None
+    os.remove(SCALE_FILE)
+    return count
+
+def read_stop_request():
+    if not os.path.exists(STOP_FILE):
+        return None
+    try:
+        with open(STOP_FILE, "r") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+def install_signal_handlers():
+    # Signals can only be handled on the main thread (bench runs the
+    # supervisor elsewhere and stops it through stop_event directly).
+    if threading.current_thread() is not threading.main_thread():
+        return {}
+    previous = {}
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        previous[signum] = signal.signal(signum, lambda *_: stop_event.set())
+    return previous
+
+def node_lease(pool, expires):
+    return {"node": NODE_ID, "host": socket.gethostname(), "pid": os.getpid(),
+            "workers": pool.size(), "registry": pool.registry(), "expires": expires}
+
+def abandon_jobs(busy, grace):
+    # Takes back the jobs of workers that outlived a drain timeout, then stops
+    # the processes they are waiting on so nothing keeps running after the
+    # jobs are requeued. In-thread tasks cannot be interrupted, but their
+    # results are dropped the same way.
+    jobs = []
+    for s in busy:
+        with s.ack_lock:
+            s.abandoned = True
+            jobs.extend(s.in_flight)
+            s.current_job = None
+            s.in_flight = []
+    for s in busy:
+        proc = worker_processes.get(s.thread_id)
+        if proc is not None:
+            stop_process_group(proc, grace)
+    return jobs
+
+def start_workers(count: int, executor=None, backend="file", stats=None, samples=False,
+                  metrics_port=None, metrics_file=None, profile=False, profile_pstats=None, profile_trace=None,
+                  autoscale=None, server=None, task_processes=None):
+    global task_pool
+    settings = LiveConfig()
+    store = make_store(backend, server)
+    stop_event.clear()
+    log_listener = setup_logging(settings.config)
+    try:
+        load_task_modules(settings.config["task_modules"])
+    except ImportError as e:
+        log_event(logging.ERROR, f"Could not import task modules: {e}", outcome="task_import_failed")
+    if task_processes:
+        # Spawned rather than forked: the supervisor already runs threads.
+        task_pool = concurrent.futures.ProcessPoolExecutor(
+            task_processes, mp_context=multiprocessing.get_context("spawn"),
+            initializer=load_task_modules, initargs=(settings.config["task_modules"],))
+
+    for flag in (STOP_FILE, SCALE_FILE):
+        if os.path.exists(flag):
+            os.remove(flag)
 
     with open(WORKER_PID_FILE, "w") as f:
         f.write(str(os.getpid()))
 
-    threads = []
-    for i in range(count):
-        t = threading.Thread(target=worker_thread, args=(i + 1, config), daemon=True)
-        t.start()
-        threads.append(t)
+    stats = [] if stats is None else stats
+    profiler = None
+    if profile and profile_pstats and PROFILE_ALL_THREADS:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            log_event(logging.WARNING, f"cProfile stats disabled: {e}", outcome="profile_failed")
+            profiler = None
+    pool = WorkerPool(settings, executor, store, stats, samples=samples, profile=profile, profile_pstats=profile_pstats)
+    autoscaler = None
+    if autoscale:
+        minimum, maximum = autoscale
+        count = max(minimum, min(maximum, count))
+        autoscaler = Autoscaler(pool, minimum, maximum)
+    # Hold a lease before the first claim, or another node could reclaim
+    # this one's limit and running slots as a dead node's.
+    store.heartbeat(node_lease(pool, time.time() + LEASE_TTL))
+    pool.resize(count)
+    watchdog = Watchdog(pool)
+
+    # Queue depth is sampled every metrics_interval seconds and shared by the
+    # textfile and the HTTP endpoint.
+    depth = {}
+    watcher = QueueWatcher() if (metrics_port or metrics_file) and backend == "file" else None
+    next_metrics = 0
+    metrics_server = serve_metrics(metrics_port, stats, depth) if metrics_port else None
+    if metrics_server:
+        print(f"Serving metrics on http://127.0.0.1:{metrics_port}/metrics")
+
+    # With a queue server the server owns the schedule and hooks, so only one host runs them.
+    scheduler = Scheduler(store) if backend == "file" else None
+    hooks = None
+    if backend == "file":
+        hooks = threading.Thread(target=HookDispatcher().run, args=(stop_event,), daemon=True)
+        hooks.start()
+
+    previous_handlers = install_signal_handlers()
+    next_lease = 0
 
     print(f"Started {count} worker(s). Run 'queuectl worker stop' to stop them.")
+    stop_request = None
     try:
-        while True:
-            if os.path.exists(STOP_FILE):
+        while not stop_event.is_set():
+            stop_request = read_stop_request()
+            if stop_request is not None:
                 break
-            time.sleep(1)
+            if scheduler:
+                scheduler.tick()
+            now = time.time()
+            if now >= next_lease:
+                store.heartbeat(node_lease(pool, now + LEASE_TTL))
+                next_lease = now + LEASE_INTERVAL
+            settings.refresh()
+            requested = read_scale_request()
+            if requested is not None and requested != pool.size():
+                log_event(logging.INFO, f"Scaling from {pool.size()} to {requested} worker(s).",
+                          outcome="scaled", workers=requested)
+                pool.resize(requested)
+            if autoscaler:
+                autoscaler.tick(settings.config)
+            watchdog.tick(settings.config)
+            if (metrics_port or metrics_file) and now >= next_metrics:
+                depth.update(queue_depth(store, watcher))
+                if metrics_file:
+                    write_metrics_file(metrics_file, stats, depth)
+                next_metrics = now + settings.config["metrics_interval"]
+            stop_event.wait(1)
     except KeyboardInterrupt:
         pass
 
+    stop_request = stop_request or read_stop_request() or {}
     stop_event.set()
-    for t in threads:
-        t.join()
+    pool.stop()
+    timeout = stop_request.get("timeout") if stop_request.get("drain") else None
+    busy = pool.join(timeout)
+    abandoned = abandon_jobs(busy, settings.config.get("kill_grace", 5))
+    if abandoned:
+        store.release(abandoned)
+        log_event(logging.WARNING, f"Drain timed out, requeued {len(abandoned)} in-flight job(s).",
+                  outcome="requeued", jobs=[job.get("id") for job in abandoned])
+    store.heartbeat(node_lease(pool, 0))
+    if task_pool:
+        task_pool.shutdown(wait=False, cancel_futures=True)
+        task_pool = None
+    if hooks:
+        hooks.join(HOOK_TIMEOUT + 1)
+    for signum, handler in previous_handlers.items():
+        signal.signal(signum, handler)
+    log_listener.stop()
 
-    if os.path.exists(STOP_FILE):
-        os.remove(STOP_FILE)
+    if metrics_file:
+        depth.update(queue_depth(store, watcher))
+        write_metrics_file(metrics_file, stats, depth)
+    if metrics_server:
+        metrics_server.shutdown()
+    if profiler:
+        profiler.disable()
+    if profile:
+        print_profile_summary(stats)
+        if profile_pstats:
+            write_profile_pstats(profile_pstats, stats, profiler)
+        if profile_trace:
+            write_profile_trace(profile_trace, stats)
+
+    for flag in (STOP_FILE, SCALE_FILE):
+        if os.path.exists(flag):
+            os.remove(flag)
     if os.path.exists(WORKER_PID_FILE):
         os.remove(WORKER_PID_FILE)
 
     print("All workers stopped gracefully.")
+    return stats
+
+def run_server(host, port):
+    config = load_config()
+    token = os.environ.get(TOKEN_ENV)
+    if host not in LOOPBACK_HOSTS and not token:
+        # Anyone who can enqueue can run commands on the workers.
+        print(f"Refusing to listen on {host} without a token; set {TOKEN_ENV} on the server and every client.")
+        return
+    log_listener = setup_logging(config)
+    try:
+        queue_server = QueueServer((host, port), token)
+    except OSError as e:
+        print(f"Could not listen on {host}:{port}: {e}")
+        log_listener.stop()
+        return
+    threading.Thread(target=queue_server.serve_forever, daemon=True).start()
+    scheduler = Scheduler(queue_server.store)
+    stop_event.clear()
+    hooks = threading.Thread(target=HookDispatcher().run, args=(stop_event,), daemon=True)
+    hooks.start()
+    previous_handlers = install_signal_handlers()
+
+    print(f"Queue server listening on {host}:{queue_server.server_address[1]}. Press Ctrl+C to stop.")
+    try:
+        while not stop_event.is_set():
+            scheduler.tick()
+            stop_event.wait(1)
+    except KeyboardInterrupt:
+        pass
+
+    stop_event.set()
+    queue_server.shutdown()
+    queue_server.server_close()
+    hooks.join(HOOK_TIMEOUT + 1)
+    for signum, handler in previous_handlers.items():
+        signal.signal(signum, handler)
+    log_listener.stop()
+    print("Queue server stopped.")
+
+def scale_workers(count):
+    if count < 0:
+        print("Worker count must be zero or more.")
+        return
+    if not os.path.exists(WORKER_PID_FILE):
+        print("No workers are running.")
+        return
+    with open(SCALE_FILE, "w") as f:
+        f.write(str(count))
+    print(f"Scale request sent: {count} worker(s).")
+
+def read_worker_pid():
+    if not os.path.exists(WORKER_PID_FILE):
+        return None
+    try:
+        with open(WORKER_PID_FILE, "r") as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
 
-def stop_workers():
+def stop_workers(drain=False, timeout=None):
     with open(STOP_FILE, "w") as f:
-        f.write("stop")
+        json.dump({"drain": drain, "timeout": timeout}, f)
 
-    print("Stop signal sent, workers will stop within a second.")
-    time.sleep(1)
+    pid = read_worker_pid()
+    if pid is None or not psutil.pid_exists(pid):
+        print("Stop signal sent, but no running workers were found.")
+        if os.path.exists(WORKER_PID_FILE):
+            os.remove(WORKER_PID_FILE)
+        return
+    if os.name == "posix":
+        os.kill(pid, signal.SIGTERM)
 
-    if os.path.exists(WORKER_PID_FILE):
-        os.remove(WORKER_PID_FILE)
+    if drain:
+        print(f"Draining workers (PID {pid}): no new jobs will be claimed.")
+    else:
+        print(f"Stop signal sent to workers (PID {pid}).")
+    deadline = time.monotonic() + (timeout + 5 if timeout is not None else 10)
+    while time.monotonic() < deadline:
+        if not psutil.pid_exists(pid) or not os.path.exists(WORKER_PID_FILE):
+            print("All workers stopped.")
+            return
+        time.sleep(0.2)
+    print("Workers are still finishing in-flight jobs; check 'queuectl status'.")
 
 
 import psutil  
-def status_workers():
-    pending = load_jobs(QUEUE_FILE)
-    processed = load_jobs(PROCESSED_FILE)
-    failed = load_jobs(FAILED_FILE)
+class QueueWatcher:
+    # Starts from one consistent snapshot, then follows the journal, so each
+    # refresh costs O(new records) instead of re-reading every job file.
+    def __init__(self):
+        self.states = {}
+        with lock:
+            for state, file_path in (("pending", QUEUE_FILE), ("processed", PROCESSED_FILE), ("failed", FAILED_FILE)):
+                for job in load_jobs(file_path):
+                    self.states[job.get("id")] = state
+            for job_id in load_waiting()["jobs"]:
+                self.states[job_id] = "waiting"
+            self.offset = journal_offset()
+        self.counts = Counter(self.states.values())
+        self.mtimes = {}
+        self.scheduled = 0
+        self.cache = None
 
-    if os.path.exists(WORKER_PID_FILE):
-        with open(WORKER_PID_FILE, "r") as f:
-            pid = int(f.read().strip())
-        if psutil.pid_exists(pid):
-            worker_state = f"Running (PID {pid})"
-        else:
-            worker_state = "Stopped"
+    def poll(self):
+        # Returns whether anything changed since the last poll.
+        records, self.offset = read_journal(self.offset)
+        publish_journal_cursor(self.offset)
+        for record in records:
+            previous = self.states.get(record["id"])
+            if previous is not None:
+                self.counts[previous] -= 1
+            self.states[record["id"]] = record["state"]
+            self.counts[record["state"]] += 1
+        changed = bool(records)
+        # The schedule and cache are not journaled; reload them only when they change.
+        for file_path in (SCHEDULE_FILE, CACHE_DIR):
+            try:
+                mtime = os.stat(file_path).st_mtime_ns
+            except FileNotFoundError:
+                mtime = None
+            if mtime == self.mtimes.get(file_path, 0):
+                continue
+            self.mtimes[file_path] = mtime
+            changed = True
+            if file_path == SCHEDULE_FILE:
+                self.scheduled = len(load_jobs(SCHEDULE_FILE))
+            else:
+                self.cache = load_cache()
+        return changed
+
+def print_status(counts, scheduled, running=None, cache=None):
+    # Nodes renew their lease every few seconds, so an expired lease means the
+    # node is gone even when it ran on another host.
+    now = time.time()
+    nodes = [lease for lease in load_leases().values() if lease["expires"] > now]
+    if nodes:
+        total = sum(lease["workers"] for lease in nodes)
+        worker_state = f"Running ({total} worker(s) on {len(nodes)} node(s))"
     else:
         worker_state = "Stopped"
 
     print("\nQueue Status Summary")
     print("-" * 35)
-    print(f"Pending Jobs   : {len(pending)}")
-    print(f"Processed Jobs : {len(processed)}")
-    print(f"Failed Jobs    : {len(failed)}")
+    print(f"Pending Jobs   : {counts['pending']}")
+    if running is not None:
+        print(f"Running Jobs   : {running}")
+    print(f"Processed Jobs : {counts['processed']}")
+    print(f"Failed Jobs    : {counts['failed']}")
+    print(f"Scheduled      : {scheduled}")
+    print(f"Waiting Jobs   : {counts['waiting']}")
+    if cache:
+        print(f"Result Cache   : {cache['hits']} hit(s) / {cache['misses']} miss(es), {cache['entries']} entries")
     print(f"Worker State   : {worker_state}")
+    for lease in nodes:
+        print(f"  • {lease['host']} (PID {lease['pid']}): {lease['workers']} worker(s)")
     print("-" * 35)
 
-def list_jobs(state):
-    if state=='pending':
-        jobs=load_jobs(QUEUE_FILE)
-    elif state=='processed':
-        jobs=load_jobs(PROCESSED_FILE)
-    elif state=='failed':
-        jobs=load_jobs(FAILED_FILE)
-    else:
+def status_workers(watch=None):
+    if watch is None:
+        counts = {
+            "pending": len(load_jobs(QUEUE_FILE)),
+            "processed": len(load_jobs(PROCESSED_FILE)),
+            "failed": len(load_jobs(FAILED_FILE)),
+            "waiting": len(load_waiting()["jobs"]),
+        }
+        print_status(counts, len(load_jobs(SCHEDULE_FILE)), cache=load_cache())
+        return
+    watcher = QueueWatcher()
+    drawn = 0
+    try:
+        while True:
+            # Worker leases change without journal records, so redraw at
+            # least once per lease interval.
+            if watcher.poll() or time.time() - drawn >= LEASE_INTERVAL:
+                if sys.stdout.isatty():
+                    print("\033[H\033[J", end="")
+                print_status(watcher.counts, watcher.scheduled, running=watcher.counts["running"], cache=watcher.cache)
+                print(f"Updated {datetime.now().strftime('%H:%M:%S')}. Press Ctrl+C to stop.", flush=True)
+                drawn = time.time()
+            time.sleep(watch)
+    except KeyboardInterrupt:
+        pass
+
+def show_events(offset, follow, events):
+    try:
+        for next_offset, record in iter_events(offset, follow, events):
+            print(json.dumps({"offset": next_offset, **record}), flush=True)
+    except (FileNotFoundError, ValueError) as e:
+        print(f"Cannot read events: {e}")
+    except KeyboardInterrupt:
+        pass
+
+def list_workers():
+    # Reads only the lease registry, never the job files.
+    now = time.time()
+    leases = sorted(load_leases().values(), key=lambda lease: lease["node"])
+    print("\nWorkers")
+    print("-" * 40)
+    if not leases:
+        print("No workers registered.")
+    for lease in leases:
+        state = "alive" if lease["expires"] > now else "lost"
+        print(f"{lease['node']} ({state}, {lease['workers']} worker(s))")
+        for w in lease.get("registry", []):
+            job = "idle"
+            if w["job"]:
+                batch = f" +{w['batch'] - 1} in batch" if w.get("batch", 1) > 1 else ""
+                job = f"{w['job']}{batch} (running {now - w['job_started']:.1f}s)"
+            print(f"  • Worker-{w['worker']} | JOB: {job} | DONE: {w['done']} | "
+                  f"FAILED: {w['failure_rate'] * 100:.1f}% | AVG EXEC: {w['avg_exec']:.3f}s | "
+                  f"LAST SEEN: {now - w['last_seen']:.0f}s ago")
+    print("-" * 40)
+
+def list_jobs(state, follow=False):
+    sources = {
+        'pending': lambda: load_jobs(QUEUE_FILE),
+        'processed': lambda: load_jobs(PROCESSED_FILE),
+        'failed': lambda: load_jobs(FAILED_FILE),
+        'waiting': lambda: list(load_waiting()["jobs"].values()),
+    }
+    if state not in sources:
         print(f"Unknown state:{state}")
         return 
+    with lock:
+        jobs = sources[state]()
+        offset = journal_offset()
     print(f"\nJobs ({state.upper()})")
     print("-" * 40)
     if not jobs:
@@ -194,7 +3241,21 @@ def list_jobs(state):
     else:
         for job in jobs:
             print(f"• ID: {job.get('id')} | CMD: {job.get('command')}")
-    print("-" * 40)
+    if not follow:
+        print("-" * 40)
+        return
+    # Only jobs entering the state are printed; reading stays O(new records).
+    try:
+        while True:
+            records, offset = read_journal(offset)
+            publish_journal_cursor(offset)
+            for record in records:
+                if record["state"] == state:
+                    print(f"• ID: {record['id']} | CMD: {record['command']}", flush=True)
+            if not records:
+                time.sleep(0.5)
+    except KeyboardInterrupt:
+        print("-" * 40)
 
 def dlq_list():
     jobs=load_jobs(FAILED_FILE)
@@ -216,11 +3277,18 @@ def dlq_retry(job_id):
             return
         failed = [job for job in failed if job.get("id") != job_id]
         save_jobs(FAILED_FILE, failed)
+        outcomes = load_outcomes()
+        outcomes.pop(job_id, None)
+        save_outcomes(outcomes)
 
         job_to_retry["retries"] = 0
+        job_to_retry["state"] = "pending"
+        job_to_retry.pop("last_backoff", None)
         jobs = load_jobs(QUEUE_FILE)
+        track_pending(jobs, [job_to_retry])
         jobs.append(job_to_retry)
         save_jobs(QUEUE_FILE, jobs)
+        journal_append([journal_record(job_to_retry, "requeued")], load_config().get("journal_fsync"))
         print(f"Job '{job_id}' moved back to queue for retry.")
 
 
@@ -243,6 +3311,11 @@ def config_set(key, value):
     except ValueError:
         pass
     config[key] = value
+    try:
+        validate_config(config)
+    except ValueError as e:
+        print(f"Invalid value: {e}")
+        return
     save_config(config)
     print(f"Config updated: {key} = {value}")
 
@@ -252,6 +3325,326 @@ def config_get(key):
         print(f"{key}: {config[key]}")
     else:
         print(f"Unknown config key: {key}")
+
+def find_finished_job(job_id):
+    for file_path in (PROCESSED_FILE, FAILED_FILE):
+        for job in reversed(load_jobs(file_path)):
+            if job.get("id") == job_id:
+                return job
+    return None
+
+def show_result(job_id, info=False):
+    job = find_finished_job(job_id)
+    if job is None:
+        print(f"Job '{job_id}' has not finished.")
+        return
+    ref = job.get("output")
+    if info or not ref:
+        print(f"ID: {job_id} | STATE: {job.get('state')} | EXIT: {job.get('exit_code', 0)} | "
+              f"DURATION: {job.get('duration')}s")
+        if ref:
+            print(f"OUTPUT: {ref['size']} bytes | sha256:{ref['sha256']}")
+        else:
+            print("OUTPUT: none")
+        return
+    try:
+        data = load_blob(ref)
+    except (OSError, ValueError) as e:
+        print(f"Could not read output for '{job_id}': {e}")
+        return
+    sys.stdout.buffer.write(data)
+    sys.stdout.flush()
+
+def workflow_submit(path):
+    try:
+        with open(path, "r") as f:
+            spec = json.load(f)
+        user_jobs = spec["jobs"] if isinstance(spec, dict) else spec
+        jobs = [build_job(user_job) for user_job in user_jobs]
+        FileStore().enqueue(jobs)
+    except (OSError, KeyError) as e:
+        print(f"Could not read workflow: {e}")
+        return
+    except json.JSONDecodeError as e:
+        print(f"Invalid JSON input: {e}")
+        return
+    except ValueError as e:
+        print(f"Invalid workflow: {e}")
+        return
+    waiting = sum(1 for job in jobs if job.get("state") == "waiting")
+    print(f"Submitted workflow: {len(jobs)} job(s), {len(jobs) - waiting} ready, {waiting} waiting on dependencies")
+
+def schedule_add(cron, job_data, schedule_id=None):
+    try:
+        user_job = json.loads(job_data)
+        build_job(user_job)
+    except json.JSONDecodeError as e:
+        print(f"Invalid JSON input: {e}")
+        return
+    except ValueError as e:
+        print(f"Invalid job: {e}")
+        return
+    try:
+        run_at = cron_next(cron, time.time())
+    except ValueError as e:
+        print(f"Invalid cron expression: {e}")
+        return
+    schedule_id = schedule_id or user_job.get("id")
+    if not schedule_id or schedule_id.startswith(("once:", "retry:")):
+        print("Schedules need an id that does not start with 'once:' or 'retry:'.")
+        return
+    try:
+        schedule_entry({"id": schedule_id, "run_at": run_at, "cron": cron, "job": user_job})
+    except ValueError as e:
+        print(f"{e}; remove it first with 'queuectl schedule remove {schedule_id}'.")
+        return
+    print(f"Scheduled '{schedule_id}' ({cron}), next run at {datetime.fromtimestamp(run_at).isoformat()}")
+
+def schedule_list():
+    entries = sorted(load_jobs(SCHEDULE_FILE), key=lambda e: e["run_at"])
+    print("\nScheduled Jobs")
+    print("-" * 40)
+    if not entries:
+        print("No scheduled jobs.")
+    for entry in entries:
+        when = datetime.fromtimestamp(entry["run_at"]).isoformat(timespec="seconds")
+        print(f"ID: {entry['id']} | NEXT: {when} | CRON: {entry.get('cron') or 'once'} | "
+              f"CMD: {entry['job'].get('command')}")
+    print("-" * 40)
+
+def schedule_remove(schedule_id):
+    with lock:
+        entries = load_jobs(SCHEDULE_FILE)
+        remaining = [e for e in entries if e["id"] != schedule_id]
+        if len(remaining) == len(entries):
+            print(f"Schedule '{schedule_id}' not found.")
+            return
+        save_jobs(SCHEDULE_FILE, remaining)
+    print(f"Schedule '{schedule_id}' removed.")
+
+def limit_set(key, rate, burst, max_in_flight):
+    kind, _, value = key.partition(":")
+    if kind not in LIMIT_KINDS or not value:
+        print(f"Invalid limit key: {key}")
+        print("Use one of: queue:NAME, tag:NAME, prefix:COMMAND")
+        return
+    if rate is None and max_in_flight is None:
+        print("Set at least one of --rate or --max-in-flight.")
+        return
+    with lock:
+        limits = load_limits()
+        limits[key] = {"rate": rate, "burst": burst, "max_in_flight": max_in_flight}
+        with open(LIMITS_FILE, "w") as f:
+            json.dump(limits, f, indent=2)
+        state = load_limit_state()
+        state.pop(key, None)
+        save_limit_state(state)
+    print(f"Limit updated: {key} = {limits[key]}")
+
+def limit_remove(key):
+    with lock:
+        limits = load_limits()
+        if key not in limits:
+            print(f"No limit configured for '{key}'.")
+            return
+        del limits[key]
+        with open(LIMITS_FILE, "w") as f:
+            json.dump(limits, f, indent=2)
+        state = load_limit_state()
+        state.pop(key, None)
+        save_limit_state(state)
+    print(f"Limit removed: {key}")
+
+def limit_list():
+    limits = load_limits()
+    state = load_limit_state()
+    print("\nRate Limits")
+    print("-" * 40)
+    if not limits:
+        print("No limits configured.")
+    for key, rule in limits.items():
+        parts = [key]
+        if rule.get("rate") is not None:
+            parts.append(f"rate: {rule['rate']}/s (burst {rule.get('burst') or rule['rate']})")
+        if rule.get("max_in_flight") is not None:
+            parts.append(f"max in flight: {rule['max_in_flight']}")
+        parts.append(f"in flight: {state.get(key, {}).get('in_flight', 0)}")
+        print(" | ".join(parts))
+    print("-" * 40)
+
+def tenant_set(owner, weight, max_pending, max_running):
+    if weight is not None and weight < 1:
+        print("--weight must be a positive integer.")
+        return
+    if weight is None and max_pending is None and max_running is None:
+        print("Set at least one of --weight, --max-pending or --max-running.")
+        return
+    with lock:
+        tenants = load_tenants()
+        tenants[owner] = {key: value for key, value in
+                          (("weight", weight), ("max_pending", max_pending), ("max_running", max_running))
+                          if value is not None}
+        with open(TENANTS_FILE, "w") as f:
+            json.dump(tenants, f, indent=2)
+        if load_tenant_state() is None:
+            queued = load_jobs(QUEUE_FILE)
+            save_tenant_state(new_tenant_state(queued))
+            save_jobs(QUEUE_FILE, queued)
+    print(f"Tenant updated: {owner} = {tenants[owner]}")
+
+def tenant_remove(owner):
+    with lock:
+        tenants = load_tenants()
+        if owner not in tenants:
+            print(f"No tenant settings for '{owner}'.")
+            return
+        del tenants[owner]
+        with open(TENANTS_FILE, "w") as f:
+            json.dump(tenants, f, indent=2)
+    print(f"Tenant removed: {owner}")
+
+def tenant_list():
+    tenants = load_tenants()
+    state = load_tenant_state() or {"queues": {}, "running": {}}
+    print("\nTenants")
+    print("-" * 40)
+    owners = list(tenants) + [o for o in {**state["queues"], **state["running"]} if o not in tenants]
+    if not owners:
+        print("No tenants yet.")
+    for owner in owners:
+        rule = tenants.get(owner, {})
+        parts = [owner, f"weight: {rule.get('weight', 1)}",
+                 f"pending: {len(state['queues'].get(owner, []))}"
+                 + (f"/{rule['max_pending']}" if rule.get("max_pending") is not None else ""),
+                 f"running: {state['running'].get(owner, 0)}"
+                 + (f"/{rule['max_running']}" if rule.get("max_running") is not None else "")]
+        print(" | ".join(parts))
+    print("-" * 40)
+
+def hook_set(name, url, queue_name, events, batch_size, batch_wait):
+    if not url.startswith(("http://", "https://")):
+        print(f"Invalid URL: {url}")
+        return
+    hook = {"url": url, "queue": queue_name, "events": events or list(HOOK_EVENTS)}
+    if batch_size is not None:
+        hook["batch_size"] = batch_size
+    if batch_wait is not None:
+        hook["batch_wait"] = batch_wait
+    with lock:
+        hooks = load_hooks()
+        hooks[name] = hook
+        with open(HOOKS_FILE, "w") as f:
+            json.dump(hooks, f, indent=2)
+    print(f"Hook updated: {name} = {hook}")
+
+def hook_remove(name):
+    with lock:
+        hooks = load_hooks()
+        if name not in hooks:
+            print(f"No hook named '{name}'.")
+            return
+        del hooks[name]
+        with open(HOOKS_FILE, "w") as f:
+            json.dump(hooks, f, indent=2)
+    print(f"Hook removed: {name}")
+
+def hook_list():
+    hooks = load_hooks()
+    pending = load_outbox()["pending"] if os.path.exists(OUTBOX_FILE) else {}
+    print("\nCompletion Hooks")
+    print("-" * 40)
+    if not hooks:
+        print("No hooks configured.")
+    for name, hook in hooks.items():
+        print(f"{name} | {hook['url']} | queue: {hook.get('queue') or 'all'} | events: {', '.join(hook['events'])}")
+    for url, box in pending.items():
+        if box["events"]:
+            print(f"Outbox {url}: {len(box['events'])} undelivered event(s), {box['attempts']} failed attempt(s)")
+    print("-" * 40)
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, int(round(pct / 100 * len(ordered))) - 1)
+    return ordered[index]
+
+def run_bench(job_count, workers, batch_size, payload_size, backend, batchable=False):
+    workdir = tempfile.mkdtemp(prefix="queuectl-bench-")
+    origin = os.getcwd()
+    os.chdir(workdir)
+    queue_server = server = None
+    try:
+        if backend == "server":
+            queue_server = QueueServer(("127.0.0.1", 0))
+            threading.Thread(target=queue_server.serve_forever, daemon=True).start()
+            server = f"127.0.0.1:{queue_server.server_address[1]}"
+        store = make_store(backend, server)
+        enqueue_stats = WorkerStats(0, samples=True)
+        enqueued_at = {}
+        payload = "x" * payload_size
+
+        start = time.perf_counter()
+        for offset in range(0, job_count, batch_size):
+            batch = []
+            for i in range(offset, min(offset + batch_size, job_count)):
+                job = build_job({"id": f"bench-{i}", "command": "true", "batchable": batchable})
+                job["payload"] = payload
+                batch.append(job)
+            store.enqueue(batch, enqueue_stats)
+            now = time.perf_counter()
+            for job in batch:
+                enqueued_at[job["id"]] = now
+        enqueue_elapsed = time.perf_counter() - start
+
+        def stop_when_drained():
+            while not stop_event.is_set():
+                done = sum(s.succeeded + s.dead_lettered for s in worker_stats)
+                if done >= job_count:
+                    stop_event.set()
+                    break
+                time.sleep(0.05)
+
+        worker_stats = []
+        run_start = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            threading.Thread(target=stop_when_drained, daemon=True).start()
+            start_workers(workers, executor=job_exec_noop, backend=backend, stats=worker_stats, samples=True,
+                          server=server)
+        run_elapsed = time.perf_counter() - run_start
+    finally:
+        if queue_server:
+            queue_server.shutdown()
+            queue_server.server_close()
+        os.chdir(origin)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    claim = [v for s in worker_stats for v in s.claim_latency]
+    lock_wait = enqueue_stats.lock_wait + [v for s in worker_stats for v in s.lock_wait]
+    e2e = [t - enqueued_at[job_id] for s in worker_stats for job_id, t in s.finished_at.items()]
+    written = enqueue_stats.bytes_written + sum(s.bytes_written for s in worker_stats)
+
+    print("\nBenchmark Results")
+    print("-" * 40)
+    print(f"Backend        : {backend}")
+    print(f"Jobs           : {job_count} ({payload_size} byte payload)")
+    print(f"Workers        : {workers}")
+    print(f"Batch Size     : {batch_size}")
+    print(f"Batchable      : {'yes' if batchable else 'no'}")
+    print(f"Enqueue        : {job_count / enqueue_elapsed:.1f} jobs/sec")
+    print(f"Processing     : {job_count / run_elapsed:.1f} jobs/sec")
+    for label, values in (("Claim latency", claim), ("End-to-end", e2e), ("Lock wait", lock_wait)):
+        print(f"{label:<15}: p50 {percentile(values, 50) * 1000:.2f}ms | "
+              f"p95 {percentile(values, 95) * 1000:.2f}ms | p99 {percentile(values, 99) * 1000:.2f}ms")
+    print(f"Bytes/job      : {written / job_count:.0f}")
+    print("-" * 40)
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
 def main():
     parser = argparse.ArgumentParser(description="QueueCLI")
     subparsers = parser.add_subparsers(dest="command", help="Commands")
@@ -259,6 +3652,9 @@ def main():
     # enqueue
     enqueue_parser = subparsers.add_parser("enqueue", help="Add a job to the queue")
     enqueue_parser.add_argument("--json", help="Job data in JSON format")
+    enqueue_parser.add_argument("--run-at", help="Run at this ISO-8601 time instead of immediately")
+    enqueue_parser.add_argument("--delay", type=float, help="Run after this many seconds")
+    enqueue_parser.add_argument("--server", help="Enqueue through a queue server at HOST:PORT")
 
     # worker
     worker_parser = subparsers.add_parser("worker", help="Worker management")
@@ -266,12 +3662,35 @@ def main():
 
     start_parser = worker_sub.add_parser("start", help="Start one or more workers")
     start_parser.add_argument("--count", type=int, default=1, help="Number of workers to start")
+    start_parser.add_argument("--metrics-port", type=int, help="Serve Prometheus metrics on this local port")
+    start_parser.add_argument("--metrics-file", help="Write Prometheus metrics to this textfile-collector file")
+    start_parser.add_argument("--autoscale-min", type=int, default=1, help="Smallest pool size when autoscaling")
+    start_parser.add_argument("--autoscale-max", type=int, help="Enable autoscaling up to this many workers")
+    start_parser.add_argument("--profile", action="store_true", help="Record per-phase timings and print a summary on stop")
+    start_parser.add_argument("--profile-pstats", help="With --profile, also write a merged cProfile dump here")
+    start_parser.add_argument("--profile-trace", help="With --profile, also write Chrome trace-event JSON here")
+    start_parser.add_argument("--server", help="Claim jobs from a queue server at HOST:PORT instead of local files")
+    start_parser.add_argument("--task-processes", type=int, help="Run Python task jobs in a pool of this many processes")
 
-    worker_sub.add_parser("stop", help="Stop running workers")
-    subparsers.add_parser("status", help="Show summary of job states & active workers")
+    stop_parser = worker_sub.add_parser("stop", help="Stop running workers")
+    stop_parser.add_argument("--drain", action="store_true", help="Let in-flight jobs finish, then requeue leftovers")
+    stop_parser.add_argument("--timeout", type=float, help="With --drain, seconds to wait for in-flight jobs")
+    scale_parser = worker_sub.add_parser("scale", help="Resize the running worker pool")
+    scale_parser.add_argument("count", type=int, help="New number of workers")
+    status_parser = subparsers.add_parser("status", help="Show summary of job states & active workers")
+    status_parser.add_argument("--watch", type=float, nargs="?", const=1.0,
+                               help="Keep running and refresh when jobs change (poll interval, default 1s)")
+    subparsers.add_parser("workers", help="List registered workers with live stats")
     
+    events_parser = subparsers.add_parser("events", help="Print job state changes from the event log")
+    events_parser.add_argument("--from", dest="offset", type=int, default=0,
+                               help="Start after this offset (the 'offset' of the last event you processed)")
+    events_parser.add_argument("--follow", action="store_true", help="Keep printing new events as they happen")
+    events_parser.add_argument("--type", action="append", choices=JOURNAL_EVENTS, help="Only this event type (repeatable)")
+
     list_parser=subparsers.add_parser("list",help="list jobs by state")
     list_parser.add_argument("--state",required=True, help="State to list")
+    list_parser.add_argument("--follow", action="store_true", help="Keep printing jobs as they enter the state")
 
     dlq_parser=subparsers.add_parser("dlq",help="dead letter queue operations")
     dlq_sub=dlq_parser.add_subparsers(dest="dlq_cmd",help="DLQ subcommands")
@@ -280,6 +3699,12 @@ def main():
     retry_parser=dlq_sub.add_parser("retry",help="retry a DLQ job")
     retry_parser.add_argument("job_id",help="job ID to retry")
 
+    # server
+    server_parser = subparsers.add_parser("server", help="Serve the local queue to workers on other hosts")
+    server_parser.add_argument("--host", default="127.0.0.1",
+                               help=f"Address to listen on; other than loopback requires {TOKEN_ENV}")
+    server_parser.add_argument("--port", type=int, default=7600, help="Port to listen on")
+
     # config
     config_parser = subparsers.add_parser("config", help="Manage configuration")
     config_sub = config_parser.add_subparsers(dest="config_cmd", help="Config subcommands")
@@ -290,6 +3715,76 @@ def main():
     config_set_parser.add_argument("value", help="Value")
     config_get_parser = config_sub.add_parser("get", help="Get configuration value")
     config_get_parser.add_argument("key", help="Config key")
+
+    # result
+    result_parser = subparsers.add_parser("result", help="Print the captured output of a finished job")
+    result_parser.add_argument("job_id", help="Job ID")
+    result_parser.add_argument("--info", action="store_true", help="Show result metadata instead of the output")
+
+    # workflow
+    workflow_parser = subparsers.add_parser("workflow", help="Submit jobs with dependencies")
+    workflow_sub = workflow_parser.add_subparsers(dest="workflow_cmd", help="Workflow subcommands")
+    workflow_submit_parser = workflow_sub.add_parser("submit", help="Submit a workflow file")
+    workflow_submit_parser.add_argument("file", help='JSON file with {"jobs": [...]}')
+
+    # schedule
+    schedule_parser = subparsers.add_parser("schedule", help="Recurring jobs")
+    schedule_sub = schedule_parser.add_subparsers(dest="schedule_cmd", help="Schedule subcommands")
+    schedule_add_parser = schedule_sub.add_parser("add", help="Add a cron schedule")
+    schedule_add_parser.add_argument("--cron", required=True, help='Cron expression, e.g. "*/5 * * * *"')
+    schedule_add_parser.add_argument("--json", required=True, help="Job template in JSON format")
+    schedule_add_parser.add_argument("--id", help="Schedule ID (defaults to the job ID)")
+    schedule_sub.add_parser("list", help="List scheduled and delayed jobs")
+    schedule_remove_parser = schedule_sub.add_parser("remove", help="Remove a schedule")
+    schedule_remove_parser.add_argument("schedule_id", help="Schedule ID")
+
+    # tenant
+    tenant_parser = subparsers.add_parser("tenant", help="Fair-share weights and quotas per job owner")
+    tenant_sub = tenant_parser.add_subparsers(dest="tenant_cmd", help="Tenant subcommands")
+    tenant_set_parser = tenant_sub.add_parser("set", help="Create or replace an owner's settings")
+    tenant_set_parser.add_argument("owner", help="Job owner")
+    tenant_set_parser.add_argument("--weight", type=int, help="Share of claims relative to other owners (default 1)")
+    tenant_set_parser.add_argument("--max-pending", type=int, help="Reject enqueues beyond this many pending jobs")
+    tenant_set_parser.add_argument("--max-running", type=int, help="Maximum concurrently running jobs")
+    tenant_remove_parser = tenant_sub.add_parser("remove", help="Remove an owner's settings")
+    tenant_remove_parser.add_argument("owner", help="Job owner")
+    tenant_sub.add_parser("list", help="List owners with their quotas and usage")
+
+    # limit
+    limit_parser = subparsers.add_parser("limit", help="Rate limits and concurrency caps per job class")
+    limit_sub = limit_parser.add_subparsers(dest="limit_cmd", help="Limit subcommands")
+    limit_set_parser = limit_sub.add_parser("set", help="Create or replace a limit")
+    limit_set_parser.add_argument("key", help="queue:NAME, tag:NAME or prefix:COMMAND")
+    limit_set_parser.add_argument("--rate", type=float, help="Jobs started per second")
+    limit_set_parser.add_argument("--burst", type=float, help="Token bucket size (defaults to the rate)")
+    limit_set_parser.add_argument("--max-in-flight", type=int, help="Maximum concurrently running jobs")
+    limit_remove_parser = limit_sub.add_parser("remove", help="Remove a limit")
+    limit_remove_parser.add_argument("key", help="Limit key")
+    limit_sub.add_parser("list", help="List limits and current usage")
+
+    # hook
+    hook_parser = subparsers.add_parser("hook", help="Notify HTTP endpoints when jobs change state")
+    hook_sub = hook_parser.add_subparsers(dest="hook_cmd", help="Hook subcommands")
+    hook_set_parser = hook_sub.add_parser("set", help="Create or replace a hook")
+    hook_set_parser.add_argument("name", help="Hook name")
+    hook_set_parser.add_argument("--url", required=True, help="Endpoint that receives POSTed event batches")
+    hook_set_parser.add_argument("--queue", help="Only jobs from this queue (default: all)")
+    hook_set_parser.add_argument("--event", action="append", choices=JOURNAL_EVENTS,
+                                 help="Event type to send, repeatable (default: succeeded, dead_lettered)")
+    hook_set_parser.add_argument("--batch-size", type=int, help=f"Events per request (default {HOOK_BATCH_SIZE})")
+    hook_set_parser.add_argument("--batch-wait", type=float, help=f"Seconds to wait for a fuller batch (default {HOOK_BATCH_WAIT})")
+    hook_remove_parser = hook_sub.add_parser("remove", help="Remove a hook")
+    hook_remove_parser.add_argument("name", help="Hook name")
+    hook_sub.add_parser("list", help="List hooks and undelivered events")
+
+    # bench
+    bench_parser = subparsers.add_parser("bench", help="Measure queue throughput and latency")
+    bench_parser.add_argument("--jobs", type=positive_int, default=1000, help="Number of synthetic jobs")
+    bench_parser.add_argument("--workers", type=positive_int, default=4, help="Number of workers")
+    bench_parser.add_argument("--batch-size", type=positive_int, default=1, help="Jobs enqueued per storage write")
+    bench_parser.add_argument("--payload-size", type=int, default=0, help="Bytes of payload per job")
+    bench_parser.add_argument("--backend", default="file", choices=sorted(STORAGE_BACKENDS), help="Storage backend")
+    bench_parser.add_argument("--batchable", action="store_true", help="Mark jobs batchable so workers claim them in batches")
     args = parser.parse_args()
 
 
@@ -297,38 +3792,81 @@ def main():
         job_data = args.json or input("Paste JSON job:\n> ")
         try:
             user_job = json.loads(job_data)
-            now = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
-
-            job = {
-                "id": user_job.get("id"),
-                "command": user_job.get("command"),
-                "state": "pending",
-                "attempts": 0,
-                "max_retries": user_job.get("max_retries", 3),
-                "created_at": now,
-                "updated_at": now
-            }
-
-            jobs = load_jobs(QUEUE_FILE)
-            jobs.append(job)
-            save_jobs(QUEUE_FILE, jobs)
-            print(f"Enqueued job: {job['id']}")
-
+            job = build_job(user_job)
         except json.JSONDecodeError as e:
             print(f"Invalid JSON input: {e}")
+            return
+        except ValueError as e:
+            print(f"Invalid job: {e}")
+            return
+
+        run_at = None
+        if args.run_at:
+            try:
+                run_at = datetime.fromisoformat(args.run_at.replace("Z", "+00:00")).timestamp()
+            except ValueError as e:
+                print(f"Invalid --run-at time: {e}")
+                return
+        elif args.delay:
+            run_at = time.time() + args.delay
+
+        if run_at and run_at > time.time() and args.server:
+            print("Delayed jobs must be scheduled on the queue server host.")
+        elif run_at and run_at > time.time():
+            try:
+                entry_id = schedule_job(job, run_at)
+            except QuotaExceeded as e:
+                print(f"Rejected job {job['id']}: {e}")
+                return
+            except ValueError as e:
+                print(f"Invalid job: {e}")
+                return
+            print(f"Scheduled job: {job['id'] or entry_id} as '{entry_id}' at {datetime.fromtimestamp(run_at).isoformat(timespec='seconds')}")
+        else:
+            try:
+                make_store("server" if args.server else "file", args.server).enqueue([job])
+            except QuotaExceeded as e:
+                print(f"Rejected job {job['id']}: {e}")
+                return
+            except ValueError as e:
+                print(f"Invalid job: {e}")
+                return
+            except (OSError, QueueServerError) as e:
+                print(f"Could not reach queue server: {e}")
+                return
+            if job["state"] == "waiting":
+                print(f"Enqueued job: {job['id']} (waiting on {', '.join(job['waiting_on'])})")
+            elif job["state"] == "coalesced":
+                print(f"Coalesced job: {job['id']} into pending job {job['coalesced_into']}")
+            elif job["state"] == "failed":
+                print(f"Job {job['id']} moved to DLQ: {job['error']}")
+            else:
+                print(f"Enqueued job: {job['id']}")
 
 
     elif args.command == "worker":
         if args.worker_cmd == "start":
-            start_workers(args.count)
+            start_workers(args.count, metrics_port=args.metrics_port, metrics_file=args.metrics_file,
+                          profile=args.profile, profile_pstats=args.profile_pstats, profile_trace=args.profile_trace,
+                          autoscale=(args.autoscale_min, args.autoscale_max) if args.autoscale_max else None,
+                          backend="server" if args.server else "file", server=args.server,
+                          task_processes=args.task_processes)
         elif args.worker_cmd == "stop":
-            stop_workers()
+            stop_workers(args.drain, args.timeout)
+        elif args.worker_cmd == "scale":
+            scale_workers(args.count)
         else:
             worker_parser.print_help()
+    elif args.command == "server":
+        run_server(args.host, args.port)
     elif args.command=="status":
-        status_workers()
+        status_workers(args.watch)
+    elif args.command == "workers":
+        list_workers()
+    elif args.command == "events":
+        show_events(args.offset, args.follow, args.type)
     elif args.command=="list":
-        list_jobs(args.state.lower())
+        list_jobs(args.state.lower(), args.follow)
     elif args.command == "dlq":
         if args.dlq_cmd == "list":
             dlq_list()
@@ -345,6 +3883,51 @@ def main():
             config_get(args.key)
         else:
             config_parser.print_help()
+    elif args.command == "result":
+        show_result(args.job_id, args.info)
+    elif args.command == "workflow":
+        if args.workflow_cmd == "submit":
+            workflow_submit(args.file)
+        else:
+            workflow_parser.print_help()
+    elif args.command == "schedule":
+        if args.schedule_cmd == "add":
+            schedule_add(args.cron, args.json, args.id)
+        elif args.schedule_cmd == "list":
+            schedule_list()
+        elif args.schedule_cmd == "remove":
+            schedule_remove(args.schedule_id)
+        else:
+            schedule_parser.print_help()
+    elif args.command == "tenant":
+        if args.tenant_cmd == "set":
+            tenant_set(args.owner, args.weight, args.max_pending, args.max_running)
+        elif args.tenant_cmd == "remove":
+            tenant_remove(args.owner)
+        elif args.tenant_cmd == "list":
+            tenant_list()
+        else:
+            tenant_parser.print_help()
+    elif args.command == "limit":
+        if args.limit_cmd == "set":
+            limit_set(args.key, args.rate, args.burst, args.max_in_flight)
+        elif args.limit_cmd == "remove":
+            limit_remove(args.key)
+        elif args.limit_cmd == "list":
+            limit_list()
+        else:
+            limit_parser.print_help()
+    elif args.command == "hook":
+        if args.hook_cmd == "set":
+            hook_set(args.name, args.url, args.queue, args.event, args.batch_size, args.batch_wait)
+        elif args.hook_cmd == "remove":
+            hook_remove(args.name)
+        elif args.hook_cmd == "list":
+            hook_list()
+        else:
+            hook_parser.print_help()
+    elif args.command == "bench":
+        run_bench(args.jobs, args.workers, args.batch_size, args.payload_size, args.backend, args.batchable)
     else:
         parser.print_help()
 